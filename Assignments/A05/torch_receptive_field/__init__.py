@@ -1,3 +1,6 @@
 from .receptive_field import receptive_field
+from .receptive_field import receptive_field_static
+from .receptive_field import receptive_field_graph
 from .receptive_field import receptive_field_for_unit
+from .receptive_field import receptive_field_grid
 from .receptive_field import receptive_field_visualization_2d
\ No newline at end of file
@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.nn as nn
 try:
@@ -5,20 +6,98 @@ try:
     cv2_available = True
 except ImportError:
     cv2_available = False
+try:
+    from PIL import Image
+    pil_available = True
+except ImportError:
+    pil_available = False
+import operator
 import numpy as np
-import matplotlib.pyplot as plt
+import torch.nn.functional as F
 from torch.autograd import Variable
-from matplotlib.animation import FuncAnimation
 from collections import OrderedDict
 
 
+pointwise_operations = ['ReLU', 'LeakyReLU',
+                        'ELU', 'Hardshrink', 'Hardsigmoid', 'Hardtanh', 'LogSigmoid', 'PReLU',
+                        'ReLU6', 'RReLU', 'SELU', 'CELU', 'GELU', 'Sigmoid', 'SiLU', 'Mish',
+                        'Softplus', 'Softshrink', 'Softsign', 'Tanh', 'Tanhshrink', 'Threshold', 'GLU']
+
+
 def check_same(stride):
     if isinstance(stride, (list, tuple)):
-            assert (len(stride) == 2 and stride[0] == stride[1]) or (len(stride) == 3 and stride[0] == stride[1] and stride[1] == stride[2])
+            assert len(set(stride)) == 1
             stride = stride[0]
     return stride
 
 
+def layer_params(module, class_name):
+    """kernel_size, stride, padding, dilation of a conv/pool layer as scalars, padding='same'/'valid' are converted to numbers"""
+    kernel_size, stride = check_same(module.kernel_size), check_same(module.stride)
+    if class_name.startswith("AvgPool"):
+        # Avg Pooling does not have dilation, set it to 1 (no dilation)
+        dilation = 1
+    else:
+        dilation = check_same(module.dilation)
+    padding = module.padding
+    if padding == "same":
+        padding = (kernel_size - 1) * dilation / 2
+    elif padding == "valid":
+        padding = 0
+    return kernel_size, stride, check_same(padding), dilation
+
+
+def layer_receptive_field(module, class_name, p_j, p_r, p_start):
+    """(j, r, start) after `module` given the values before it, None for transposed convolutions (deconv stage)"""
+    if class_name in ["Conv2d", "MaxPool2d", "AvgPool2d", "Conv3d", "MaxPool3d"]:
+        kernel_size, stride, padding, dilation = layer_params(module, class_name)
+        return (p_j * stride,
+                p_r + ((kernel_size - 1) * dilation) * p_j,
+                p_start + ((kernel_size - 1) / 2 - padding) * p_j)
+    elif class_name in pointwise_operations or class_name in ["BatchNorm2d", "Bottleneck", "BatchNorm3d"]:
+        return p_j, p_r, p_start
+    elif class_name in ["ConvTranspose2d", "ConvTranspose3d"]:
+        return None
+    raise ValueError("module {} not ok".format(class_name))
+
+
+def layer_output_shape(module, class_name, input_shape):
+    """output shape [batch, channels, *spatial] of `module` computed from the input shape, without running it"""
+    if class_name in pointwise_operations or class_name in ["BatchNorm2d", "Bottleneck", "BatchNorm3d"]:
+        return list(input_shape)
+    kernel_size, stride, padding, dilation = layer_params(module, class_name)
+    channels = getattr(module, "out_channels", input_shape[1])
+    if class_name.startswith("ConvTranspose"):
+        output_padding = check_same(module.output_padding)
+        spatial = [(n - 1) * stride - 2 * padding + dilation * (kernel_size - 1) + output_padding + 1 for n in input_shape[2:]]
+    else:
+        rounding = np.ceil if getattr(module, "ceil_mode", False) else np.floor
+        spatial = [int(rounding((n + 2 * padding - dilation * (kernel_size - 1) - 1) / stride + 1)) for n in input_shape[2:]]
+    return [input_shape[0], channels] + [int(n) for n in spatial]
+
+
+def print_receptive_field(receptive_field):
+    print("------------------------------------------------------------------------------")
+    line_new = "{:>20}  {:>10} {:>10} {:>10} {:>15} ".format("Layer (type)", "map size", "start", "jump", "receptive_field")
+    print(line_new)
+    print("==============================================================================")
+    for layer in receptive_field:
+        # input_shape, output_shape, trainable, nb_params
+        assert "start" in receptive_field[layer], layer
+        assert len(receptive_field[layer]["output_shape"]) >= 2
+        line_new = "{:7} {:12}  {:>10} {:>10} {:>10} {:>15} ".format(
+            "",
+            layer,
+            str(receptive_field[layer]["output_shape"][2:]),
+            str(receptive_field[layer]["start"]),
+            str(receptive_field[layer]["j"]),
+            format(str(receptive_field[layer]["r"]))
+        )
+        print(line_new)
+
+    print("==============================================================================")
+
+
 def receptive_field(model, input_size, batch_size=-1, device="cuda"):
     '''
     :parameter
@@ -32,10 +111,6 @@ def receptive_field(model, input_size, batch_size=-1, device="cuda"):
         Convention is to use half a pixel as the center for a range. center for `slice(0,5)` is 2.5.
     '''
     def register_hook(module):
-        pointwise_operations = ['ReLU', 'LeakyReLU',
-                                'ELU', 'Hardshrink', 'Hardsigmoid', 'Hardtanh', 'LogSigmoid', 'PReLU',
-                                'ReLU6', 'RReLU', 'SELU', 'CELU', 'GELU', 'Sigmoid', 'SiLU', 'Mish',
-                                'Softplus', 'Softshrink', 'Softsign', 'Tanh', 'Tanhshrink', 'Threshold', 'GLU']
 
         def hook(module, input, output):
             class_name = str(module.__class__).split(".")[-1].split("'")[0]
@@ -53,34 +128,12 @@ def receptive_field(model, input_size, batch_size=-1, device="cuda"):
                 p_j = receptive_field[p_key]["j"]
                 p_r = receptive_field[p_key]["r"]
                 p_start = receptive_field[p_key]["start"]
-                
-                if class_name == "Conv2d" or class_name == "MaxPool2d" or class_name == "AvgPool2d" or class_name == "Conv3d" or class_name == "MaxPool3d":
-                    kernel_size = module.kernel_size
-                    stride = module.stride
-                    padding = module.padding
-
-                    if class_name == "AvgPool2d":
-                        # Avg Pooling does not have dilation, set it to 1 (no dilation)
-                        dilation = 1
-                    else:
-                        dilation = module.dilation
-
-                    kernel_size, stride, padding, dilation = map(check_same, [kernel_size, stride, padding, dilation])
-                    receptive_field[m_key]["j"] = p_j * stride
-                    receptive_field[m_key]["r"] = p_r + ((kernel_size - 1) * dilation) * p_j
-                    receptive_field[m_key]["start"] = p_start + ((kernel_size - 1) / 2 - padding) * p_j
-                elif class_name in pointwise_operations or class_name == "BatchNorm2d" or class_name == "Bottleneck" or class_name == "BatchNorm3d":
-                    receptive_field[m_key]["j"] = p_j
-                    receptive_field[m_key]["r"] = p_r
-                    receptive_field[m_key]["start"] = p_start
-                elif class_name == "ConvTranspose2d" or class_name == "ConvTranspose3d":
+
+                rf = layer_receptive_field(module, class_name, p_j, p_r, p_start)
+                if rf is None:
                     receptive_field["0"]["conv_stage"] = False
-                    receptive_field[m_key]["j"] = 0
-                    receptive_field[m_key]["r"] = 0
-                    receptive_field[m_key]["start"] = 0
-                else:
-                    raise ValueError("module {} not ok".format(class_name))
-                    pass
+                    rf = (0, 0, 0)
+                receptive_field[m_key]["j"], receptive_field[m_key]["r"], receptive_field[m_key]["start"] = rf
             receptive_field[m_key]["input_shape"] = list(input[0].size()) # only one
             receptive_field[m_key]["input_shape"][0] = batch_size
             if isinstance(output, (list, tuple)):
@@ -139,30 +192,236 @@ def receptive_field(model, input_size, batch_size=-1, device="cuda"):
     for h in hooks:
         h.remove()
 
-    print("------------------------------------------------------------------------------")
-    line_new = "{:>20}  {:>10} {:>10} {:>10} {:>15} ".format("Layer (type)", "map size", "start", "jump", "receptive_field")
-    print(line_new)
-    print("==============================================================================")
-    for layer in receptive_field:
-        # input_shape, output_shape, trainable, nb_params
-        assert "start" in receptive_field[layer], layer
-        assert len(receptive_field[layer]["output_shape"]) == 4 or len(receptive_field[layer]["output_shape"]) == 5
-        line_new = "{:7} {:12}  {:>10} {:>10} {:>10} {:>15} ".format(
-            "",
-            layer,
-            str(receptive_field[layer]["output_shape"][2:]),
-            str(receptive_field[layer]["start"]),
-            str(receptive_field[layer]["j"]),
-            format(str(receptive_field[layer]["r"]))
-        )
-        print(line_new)
-
-    print("==============================================================================")
+    print_receptive_field(receptive_field)
     # add input_shape
     receptive_field["input_size"] = input_size
     return receptive_field
 
 
+def receptive_field_static(model, input_size, batch_size=-1):
+    '''
+    Same table as `receptive_field`, without allocating any input or running a forward pass: the layers are visited in
+    registration order (the order a sequential model runs them) and the output shapes are computed analytically,
+    so it runs instantly for any model and input size, on any device.
+    :parameter
+    'input_size': tuple of (Channel, Height, Width) or (Channel, Depth, Height, Width)
+    :return  OrderedDict of `Layername`->OrderedDict of receptive field stats, as `receptive_field`
+    '''
+    receptive_field = OrderedDict()
+    receptive_field["0"] = OrderedDict()
+    receptive_field["0"]["j"] = 1.0
+    receptive_field["0"]["r"] = 1.0
+    receptive_field["0"]["start"] = 0.5
+    receptive_field["0"]["conv_stage"] = True
+    receptive_field["0"]["output_shape"] = [batch_size] + list(input_size)
+
+    shape = receptive_field["0"]["output_shape"]
+    for module in model.modules():
+        # same modules the forward hooks of `receptive_field` are registered on, containers are skipped
+        if module is model or len(list(module.children())) > 0 or isinstance(module, nn.Linear):
+            continue
+        class_name = module.__class__.__name__
+        p_stats = receptive_field["%i" % (len(receptive_field) - 1)]
+        stats = OrderedDict()
+        if not receptive_field["0"]["conv_stage"]:
+            rf = (0, 0, 0)
+        else:
+            rf = layer_receptive_field(module, class_name, p_stats["j"], p_stats["r"], p_stats["start"])
+            if rf is None:
+                receptive_field["0"]["conv_stage"] = False
+                rf = (0, 0, 0)
+        stats["j"], stats["r"], stats["start"] = rf
+        stats["input_shape"] = shape
+        shape = layer_output_shape(module, class_name, shape)
+        stats["output_shape"] = shape
+        receptive_field["%i" % len(receptive_field)] = stats
+
+    print_receptive_field(receptive_field)
+    receptive_field["input_size"] = input_size
+    return receptive_field
+
+
+# ------------------------------ graph engine ------------------------------
+# receptive_field_graph traces the model with torch.fx and visits the nodes once in topological order, so branches and
+# skip connections are followed as they are written in forward(). Where paths merge (add, cat, ...) the widest receptive
+# field is kept. Shapes are propagated analytically as in receptive_field_static.
+
+passthrough_modules = ['Identity', 'Dropout', 'Dropout1d', 'Dropout2d', 'Dropout3d', 'AlphaDropout',
+                       'BatchNorm1d', 'BatchNorm2d', 'BatchNorm3d', 'InstanceNorm1d', 'InstanceNorm2d', 'InstanceNorm3d',
+                       'GroupNorm', 'LocalResponseNorm', 'Bottleneck']
+window_modules = ['Conv1d', 'Conv2d', 'Conv3d', 'MaxPool1d', 'MaxPool2d', 'MaxPool3d', 'AvgPool1d', 'AvgPool2d', 'AvgPool3d']
+passthrough_functions = [F.relu, F.gelu, F.silu, F.elu, F.leaky_relu, F.dropout, F.dropout2d, F.batch_norm, F.softmax,
+                         torch.relu, torch.sigmoid, torch.tanh, torch.softmax]
+passthrough_methods = ['relu', 'sigmoid', 'tanh', 'contiguous', 'clone', 'float', 'half', 'to', 'type_as', 'detach', 'softmax']
+# operations on tensors that do not return a feature map
+size_methods = ['size', 'dim', 'numel']
+merge_functions = [operator.add, operator.mul, operator.sub, torch.add, torch.mul, torch.cat, torch.stack]
+functional_modules = {F.max_pool1d: nn.MaxPool1d, F.max_pool2d: nn.MaxPool2d, F.max_pool3d: nn.MaxPool3d,
+                      F.avg_pool1d: nn.AvgPool1d, F.avg_pool2d: nn.AvgPool2d, F.avg_pool3d: nn.AvgPool3d}
+
+
+def window_receptive_field(p_stats, kernel_size, stride, padding, dilation):
+    return OrderedDict(j=p_stats["j"] * stride,
+                       r=p_stats["r"] + ((kernel_size - 1) * dilation) * p_stats["j"],
+                       start=p_stats["start"] + ((kernel_size - 1) / 2 - padding) * p_stats["j"])
+
+
+def upsample_receptive_field(p_stats, input_shape, scale_factor=None, size=None, mode="nearest"):
+    """upsampling by s divides the jump by s, interpolating modes also mix the neighbouring input unit"""
+    spatial = input_shape[2:]
+    if size is not None:
+        size = [size] * len(spatial) if isinstance(size, int) else list(size)
+    else:
+        factors = [scale_factor] * len(spatial) if not isinstance(scale_factor, (list, tuple)) else list(scale_factor)
+        size = [int(np.floor(n * f)) for n, f in zip(spatial, factors)]
+    scale = max(s / n for s, n in zip(size, spatial))
+    j = p_stats["j"] / scale
+    r = p_stats["r"] + (0 if mode == "nearest" else p_stats["j"])
+    start = p_stats["start"] + (0.5 / scale - 0.5) * p_stats["j"]
+    return OrderedDict(j=j, r=r, start=start), list(input_shape[:2]) + size
+
+
+def global_receptive_field(p_stats, input_shape):
+    """layers that mix every spatial position (flatten, linear, global pooling) see the union of all units' fields"""
+    extent = max(input_shape[2:], default=1) - 1
+    return OrderedDict(j=p_stats["j"], r=p_stats["r"] + extent * p_stats["j"], start=p_stats["start"] + extent * p_stats["j"] / 2)
+
+
+def module_rule(module, p_stats, input_shape):
+    """(stats, output_shape) of a module applied to a single input"""
+    class_name = module.__class__.__name__
+    if class_name in window_modules:
+        kernel_size, stride, padding, dilation = layer_params(module, class_name)
+        return window_receptive_field(p_stats, kernel_size, stride, padding, dilation), layer_output_shape(module, class_name, input_shape)
+    elif class_name in ['ConvTranspose1d', 'ConvTranspose2d', 'ConvTranspose3d']:
+        # a transposed convolution is a zero-insertion upsampling by `stride` followed by a convolution padded by d(k-1)-p
+        kernel_size, stride, padding, dilation = layer_params(module, class_name)
+        j = p_stats["j"] / stride
+        stats = OrderedDict(j=j, r=p_stats["r"] + (kernel_size - 1) * dilation * j, start=p_stats["start"] + (padding - (kernel_size - 1) * dilation / 2) * j)
+        return stats, layer_output_shape(module, class_name, input_shape)
+    elif class_name == 'Upsample':
+        return upsample_receptive_field(p_stats, input_shape, module.scale_factor, module.size, module.mode)
+    elif class_name in pointwise_operations or class_name in passthrough_modules:
+        return OrderedDict(j=p_stats["j"], r=p_stats["r"], start=p_stats["start"]), list(input_shape)
+    elif class_name == 'Flatten':
+        return global_receptive_field(p_stats, input_shape), list(input_shape[:module.start_dim]) + [int(np.prod(input_shape[module.start_dim:]))]
+    elif class_name == 'Linear':
+        stats = global_receptive_field(p_stats, input_shape) if len(input_shape) > 2 else OrderedDict(p_stats)
+        return stats, list(input_shape[:-1]) + [module.out_features]
+    elif class_name.startswith('AdaptiveAvgPool') or class_name.startswith('AdaptiveMaxPool'):
+        output_size = module.output_size
+        output_size = [output_size] * (len(input_shape) - 2) if isinstance(output_size, int) else list(output_size)
+        output_size = [n if o is None else o for n, o in zip(input_shape[2:], output_size)]
+        if all(o == 1 for o in output_size):
+            return global_receptive_field(p_stats, input_shape), list(input_shape[:2]) + output_size
+        # adaptive pooling to a larger map behaves like a window of ceil(n / o)
+        kernel_size = max(int(np.ceil(n / o)) for n, o in zip(input_shape[2:], output_size))
+        stride = max(n // o for n, o in zip(input_shape[2:], output_size))
+        return window_receptive_field(p_stats, kernel_size, stride, 0, 1), list(input_shape[:2]) + output_size
+    raise ValueError("module {} not ok".format(class_name))
+
+
+def merge_shapes(target, shapes, args, kwargs):
+    dim = args[1] if len(args) > 1 else kwargs.get("dim", 0)
+    if target is torch.cat:
+        dim = dim % len(shapes[0])
+        return [sum(shape[dim] for shape in shapes) if axis == dim else n for axis, n in enumerate(shapes[0])]
+    if target is torch.stack:
+        dim = dim % (len(shapes[0]) + 1)
+        return shapes[0][:dim] + [len(shapes)] + shapes[0][dim:]
+    # broadcasting, the largest size along every axis
+    ndim = max(len(shape) for shape in shapes)
+    padded = [[1] * (ndim - len(shape)) + list(shape) for shape in shapes]
+    return [max(sizes) for sizes in zip(*padded)]
+
+
+def reshape_shape(input_shape, shape, batch_size):
+    """output shape of view/reshape, a leading -1 or x.size(0) is taken as the batch dimension"""
+    shape = list(shape[0]) if len(shape) == 1 and isinstance(shape[0], (list, tuple)) else list(shape)
+    shape = [batch_size if isinstance(n, torch.fx.Node) else n for n in shape]
+    if shape[0] in (-1, batch_size):
+        leading, dims, numel = [batch_size], shape[1:], int(np.prod(input_shape[1:]))
+    else:
+        leading, dims, numel = [], shape, int(np.prod(input_shape[1:])) * max(input_shape[0], 1)
+    if -1 in dims:
+        dims[dims.index(-1)] = numel // int(np.prod([n for n in dims if n != -1]))
+    return leading + dims
+
+
+def receptive_field_graph(model, input_size, batch_size=-1):
+    '''
+    Receptive field of every operation of a traced model, including models with branches and skip connections (U-Nets,
+    residual blocks), padding='same', upsampling and transposed convolutions, 1D/2D/3D layers, dropout and flatten.
+    :parameter
+    'input_size': tuple of (Channel, Length), (Channel, Height, Width) or (Channel, Depth, Height, Width)
+    :return  OrderedDict of `Layername`->OrderedDict of receptive field stats as `receptive_field`, every entry also has
+        'name': the name of the traced node (e.g. conv1.0, add_1, ...)
+    '''
+    graph_module = torch.fx.symbolic_trace(model)
+    receptive_field = OrderedDict()
+    stats_of = {}
+
+    def add_entry(node, stats, input_shape, output_shape):
+        stats = OrderedDict(stats)
+        stats["input_shape"] = input_shape
+        stats["output_shape"] = output_shape
+        stats["name"] = node.name
+        stats_of[node] = stats
+        receptive_field["%i" % len(receptive_field)] = stats
+
+    def tensor_inputs(node):
+        return [arg for arg in node.all_input_nodes if arg in stats_of]
+
+    for node in graph_module.graph.nodes:
+        if node.op == "placeholder":
+            if not stats_of:  # only the first input is analyzed
+                stats_of[node] = receptive_field["0"] = OrderedDict(j=1.0, r=1.0, start=0.5, conv_stage=True,
+                                                                    output_shape=[batch_size] + list(input_size), name=node.name)
+            continue
+        if node.op in ("output", "get_attr") or (node.op == "call_method" and node.target in size_methods) \
+                or (node.op == "call_function" and node.target is getattr):
+            continue
+
+        inputs = tensor_inputs(node)
+        if not inputs:
+            continue  # constants, sizes, ...
+        p_stats = stats_of[inputs[0]]
+        input_shape = p_stats["output_shape"]
+
+        if node.op == "call_module":
+            stats, output_shape = module_rule(graph_module.get_submodule(node.target), p_stats, input_shape)
+        elif node.op == "call_function" and (node.target in merge_functions or len(inputs) > 1):
+            # widest field among the merged paths
+            widest = max((stats_of[arg] for arg in inputs), key=lambda stats: stats["r"])
+            stats = OrderedDict(j=widest["j"], r=widest["r"], start=widest["start"])
+            output_shape = merge_shapes(node.target, [stats_of[arg]["output_shape"] for arg in inputs], node.args, node.kwargs)
+        elif node.op == "call_function" and node.target in functional_modules:
+            module = functional_modules[node.target](*node.args[1:], **node.kwargs)
+            stats, output_shape = module_rule(module, p_stats, input_shape)
+        elif node.op == "call_function" and node.target is F.interpolate:
+            kwargs = dict(zip(["size", "scale_factor", "mode"], node.args[1:]), **node.kwargs)
+            stats, output_shape = upsample_receptive_field(p_stats, input_shape, kwargs.get("scale_factor"), kwargs.get("size"), kwargs.get("mode", "nearest"))
+        elif node.op == "call_function" and node.target is torch.flatten:
+            start_dim = node.args[1] if len(node.args) > 1 else node.kwargs.get("start_dim", 0)
+            stats, output_shape = module_rule(nn.Flatten(start_dim), p_stats, input_shape)
+        elif (node.op == "call_function" and node.target in passthrough_functions) or (node.op == "call_method" and node.target in passthrough_methods):
+            stats, output_shape = OrderedDict(j=p_stats["j"], r=p_stats["r"], start=p_stats["start"]), list(input_shape)
+        elif node.op == "call_method" and node.target in ("view", "reshape", "flatten"):
+            if node.target == "flatten":
+                start_dim = node.args[1] if len(node.args) > 1 else node.kwargs.get("start_dim", 0)
+                output_shape = module_rule(nn.Flatten(start_dim), p_stats, input_shape)[1]
+            else:
+                output_shape = reshape_shape(input_shape, node.args[1:], batch_size)
+            stats = global_receptive_field(p_stats, input_shape) if len(output_shape) < len(input_shape) else OrderedDict(j=p_stats["j"], r=p_stats["r"], start=p_stats["start"])
+        else:
+            raise ValueError("operation {} not ok".format(node.target))
+        add_entry(node, stats, list(input_shape), output_shape)
+
+    print_receptive_field(receptive_field)
+    receptive_field["input_size"] = input_size
+    return receptive_field
+
+
 def receptive_field_for_unit(receptive_field_dict, layer, unit_position):
     """Utility function to calculate the receptive field for a specific unit in a layer
         using the dictionary calculated above
@@ -211,6 +470,49 @@ def receptive_field_for_unit(receptive_field_dict, layer, unit_position):
         raise KeyError("Layer name incorrect, or not included in the model.")
 
 
+def rf_table(receptive_field_dict, layer):
+    """Per-axis receptive field ranges of every unit of a layer, computed once and cached in the layer's stats as "rf_table".
+    Axis `a` is an array of shape (feature map size along a, 2) with the clipped (start, end) of each row/column."""
+    if layer not in receptive_field_dict or layer == "input_size":
+        raise KeyError("Layer name incorrect, or not included in the model.")
+    rf_stats = receptive_field_dict[layer]
+    if "rf_table" not in rf_stats:
+        input_shape = receptive_field_dict["input_size"]
+        feat_map_lim = rf_stats['output_shape'][2:]
+        # input shape is (channel, H, W) / (channel, D, H, W), or directly the spatial size
+        limit = input_shape[-len(feat_map_lim):]
+        table = []
+        for size, lim in zip(feat_map_lim, limit):
+            center = rf_stats['start'] + np.arange(size) * rf_stats['j']
+            table.append(np.stack([np.maximum(0, center - rf_stats['r'] / 2), np.minimum(lim, center + rf_stats['r'] / 2)], axis=1))
+        rf_stats["rf_table"] = table
+    return rf_stats["rf_table"]
+
+
+def receptive_field_grid(receptive_field_dict, layer, positions=None):
+    """Vectorized `receptive_field_for_unit`, receptive field boxes of many units of a layer at once
+    :parameter
+        'layer': layer name, should be a key in the result dictionary
+        'positions': integer array (N, 2) of (H, W) positions or (N, 3) of (D, H, W), None for every unit of the layer
+    :return  array (N, n_axes, 2) of (start, end) per axis, or (*feature map size, n_axes, 2) if positions is None
+    ```
+    boxes = receptive_field_grid(receptive_field_dict, "8")
+    boxes[6, 6]
+    ```
+    Out: array([[ 62., 161.], [ 62., 161.]])
+    """
+    table = rf_table(receptive_field_dict, layer)
+    if positions is None:
+        grids = np.meshgrid(*[np.arange(len(axis)) for axis in table], indexing='ij')
+        return np.stack([axis[grid] for axis, grid in zip(table, grids)], axis=-2)
+
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, len(table))
+    feat_map_lim = np.array([len(axis) for axis in table])
+    if np.any((positions < 0) | (positions >= feat_map_lim)):
+        raise Exception("Unit position outside spatial extent of the feature tensor %s " % (tuple(feat_map_lim),))
+    return np.stack([axis[positions[:, idx]] for idx, axis in enumerate(table)], axis=1)
+
+
 def read_image(image):
     if isinstance(image, np.ndarray):
         return image
@@ -225,39 +527,59 @@ def read_image(image):
         raise ValueError("Unsupported image type. Supported types: numpy array, file path")
 
 
-def receptive_field_visualization_2d(receptive_field_dict, image, save_name="receptive_field_visualization_2d"):
-    if not cv2_available:
-        raise ValueError(f"Visualization requires the cv2 module.")
-    
-    ordered_key_list = list(receptive_field_dict.keys())[:-1]
+def receptive_field_frames(receptive_field_dict, image):
+    """One BGR frame per layer: the image in color inside the receptive field of the central unit, darkened grayscale outside,
+    with the layer name and receptive field size written in a header strip"""
+    layers = [layer for layer in receptive_field_dict if layer != "input_size"]
     image_size = receptive_field_dict["input_size"][1]
-    image = read_image(image)
-    image = cv2.resize(image, (image_size, image_size))
+    image = cv2.resize(read_image(image), (image_size, image_size))
     center_x, center_y = image.shape[1] // 2, image.shape[0] // 2
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    gray_image = (gray_image * 0.5).astype(np.uint8)
-    fig, ax = plt.subplots()
 
-    def update_frame(frame_number):
-        layer = ordered_key_list[frame_number]
+    # the gray and color bases are computed once, every frame is a copy of the gray base with the receptive field pasted from the color one
+    gray_image = cv2.cvtColor((cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) * 0.5).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+    header = 24
+    base = np.full((image.shape[0] + header, image.shape[1], 3), 255, dtype=np.uint8)
+    base[header:] = gray_image
+
+    for layer in layers:
         rf_size = int(receptive_field_dict[layer]["r"])
-        image_with_rf = image.copy()
-        top_left = (center_x - rf_size // 2, center_y - rf_size // 2)
-        bottom_right = (center_x + rf_size // 2, center_y + rf_size // 2)
-
-        # Set the pixels outside of the receptive field to grayscale
-        if top_left[1] > 0:
-            image_with_rf[:int(top_left[1]), :] = cv2.cvtColor(gray_image[:int(top_left[1]), :], cv2.COLOR_GRAY2BGR)
-        if bottom_right[1] < image.shape[0]:
-            image_with_rf[int(bottom_right[1]):, :] = cv2.cvtColor(gray_image[int(bottom_right[1]):, :], cv2.COLOR_GRAY2BGR)
-        if top_left[0] > 0:
-            image_with_rf[:, :int(top_left[0])] = cv2.cvtColor(gray_image[:, :int(top_left[0])], cv2.COLOR_GRAY2BGR)
-        if bottom_right[0] < image.shape[1]:
-            image_with_rf[:, int(bottom_right[0]):] = cv2.cvtColor(gray_image[:, int(bottom_right[0]):], cv2.COLOR_GRAY2BGR)
-
-        ax.clear()
-        ax.imshow(cv2.cvtColor(image_with_rf, cv2.COLOR_BGR2RGB))
-        ax.set_title(f"Layer {layer: <3} | Receptive Field {rf_size: <3}")
-
-    ani = FuncAnimation(fig, update_frame, frames=len(ordered_key_list))
-    ani.save(f'{save_name}.gif', writer='imagemagick', fps=2)
+        top, left = max(center_y - rf_size // 2, 0), max(center_x - rf_size // 2, 0)
+        bottom, right = center_y + rf_size // 2, center_x + rf_size // 2
+        frame = base.copy()
+        frame[header + top:header + bottom, left:right] = image[top:bottom, left:right]
+        cv2.putText(frame, f"Layer {layer: <3} | Receptive Field {rf_size: <3}", (4, header - 8),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+        yield frame
+
+
+def receptive_field_visualization_2d(receptive_field_dict, image, save_name="receptive_field_visualization_2d", fmt="gif", fps=2):
+    """Animation of the receptive field of the central unit growing layer by layer.
+    The frames are encoded in-process, 'gif' (needs PIL), 'mp4' or 'png' (one file per layer in the `save_name` folder).
+    :return  path of the file (or folder) written
+    """
+    if not cv2_available:
+        raise ValueError(f"Visualization requires the cv2 module.")
+
+    frames = receptive_field_frames(receptive_field_dict, image)
+    if fmt == "gif":
+        if not pil_available:
+            raise ValueError(f"GIF encoding requires the PIL module.")
+        frames = [Image.fromarray(np.ascontiguousarray(frame[..., ::-1])) for frame in frames]
+        path = f"{save_name}.gif"
+        frames[0].save(path, save_all=True, append_images=frames[1:], duration=int(1000 / fps), loop=0)
+    elif fmt == "mp4":
+        path = f"{save_name}.mp4"
+        writer = None
+        for frame in frames:
+            if writer is None:
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+        writer.release()
+    elif fmt == "png":
+        path = save_name
+        os.makedirs(path, exist_ok=True)
+        for idx, frame in enumerate(frames):
+            cv2.imwrite(os.path.join(path, f"{idx:04d}.png"), frame)
+    else:
+        raise ValueError(f"Unsupported format {fmt}, supported formats: gif, mp4, png")
+    return path
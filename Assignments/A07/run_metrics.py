@@ -0,0 +1,60 @@
+import json
+
+# One metrics file per run, the same format as the Final_Project runs: a '# {...}' line with the run metadata as json,
+# then a csv with one row per step. Here the losses are per batch, so the rows are (split, step, loss).
+
+loss_columns = ["split", "step", "loss"]
+
+
+def metrics_path(name):
+    return f"{name}_metrics.csv"
+
+
+def init_run_metrics(path, meta, columns=loss_columns):
+    with open(path, "w") as f:
+        f.write("# " + json.dumps(meta) + "\n")
+        f.write(",".join(columns) + "\n")
+
+
+def append_run_metrics(path, rows):
+    with open(path, "a") as f:
+        f.writelines(",".join(str(value) for value in row) + "\n" for row in rows)
+
+
+def read_run_meta(path):
+    with open(path) as f:
+        return json.loads(f.readline()[2:])
+
+
+def read_losses(name):
+    """
+    Returns the train and validation losses of a run as two lists of floats.
+    """
+    losses = {"train": [], "val": []}
+    with open(metrics_path(name)) as f:
+        f.readline()
+        f.readline()
+        for line in f:
+            split, _, loss = line.rstrip("\n").split(",")
+            losses[split].append(float(loss))
+    return losses["train"], losses["val"]
+
+
+# ------------------------------ legacy pickles ------------------------------
+# the runs trained before the metrics files pickled lists of 0-d numpy arrays (train) and 0-d cpu tensors (val), they were converted once
+# with convert_loss_pickles, which needs numpy and torch to unpickle them
+
+def convert_loss_pickles(name):
+    """
+    Converts train_{name}_losses.pkl and val_{name}_losses.pkl to {name}_metrics.csv.
+    """
+    import pickle
+    import torch  # noqa: F401, the val losses are tensors
+
+    path = metrics_path(name)
+    init_run_metrics(path, {"experiment_name": name, "granularity": "batch", "source": "legacy pickles"})
+    for split in ["train", "val"]:
+        with open(f"{split}_{name}_losses.pkl", "rb") as f:
+            losses = [float(loss) for loss in pickle.load(f)]
+        append_run_metrics(path, ((split, step, loss) for step, loss in enumerate(losses)))
+    return path
@@ -1,4 +1,93 @@
 import enchant
+import numpy as np
+try:
+    import pandas as pd
+    pandas_available = True
+except ImportError:
+    pandas_available = False
+from itertools import islice
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+
+class TextAnalyzer:
+    """
+    Text metrics sharing a single dictionary.
+
+    The dictionary is loaded once and every lookup goes through a bounded LRU cache,
+    so words repeated across a text (or across many texts) are checked only once.
+
+    Parameters:
+    - language (str): The enchant dictionary tag.
+    - cache_size (int): The maximum number of distinct words kept in the lookup cache.
+    """
+
+    def __init__(self, language="en_BG", cache_size=2 ** 16):
+        self.dictionary = enchant.Dict(language)
+        self.check = lru_cache(maxsize=cache_size)(self.dictionary.check)
+
+    def english_words_ratio(self, text):
+        """
+        Calculates the ratio of English words in the given text.
+        """
+        words = text.split()
+        return sum(map(self.check, words)) / len(words)
+
+    def unique_words_ratio(self, text, english_only=False):
+        """
+        Calculates the ratio of unique words in the given text, or of English words if english_only is True.
+        """
+        words = text.split()
+        if len(words) <= 0: return 0
+        if english_only:
+            return sum(map(self.check, words)) / len(words)
+        return len(set(words)) / len(words)
+
+    def remove_non_english(self, text):
+        """
+        Removes non-English words from the given text.
+        """
+        return "".join(f"{word} " for word in text.split() if self.check(word))
+
+    def filter_lines(self, lines):
+        """
+        Streaming remove_non_english, yields the filtered text of every line.
+
+        Joining the yielded pieces gives the same string as remove_non_english on the whole text.
+        """
+        for line in lines:
+            yield self.remove_non_english(line)
+
+    def analyze(self, text):
+        """
+        Computes all the metrics of the given text splitting it only once.
+
+        Returns:
+        - dict: english_words_ratio, unique_words_ratio and the text with non-English words removed.
+        """
+        words = text.split()
+        valid = [self.check(word) for word in words]
+        n_words = max(len(words), 1)
+        return {
+            "english_words_ratio": sum(valid) / n_words,
+            "unique_words_ratio": len(set(words)) / n_words,
+            "english_text": "".join(f"{word} " for word, ok in zip(words, valid) if ok),
+        }
+
+
+_analyzer = None
+
+
+def get_analyzer():
+    """
+    Returns the TextAnalyzer shared by the module level functions, created on first use.
+    """
+    global _analyzer
+    if _analyzer is None:
+        _analyzer = TextAnalyzer()
+    return _analyzer
+
 
 def english_words_ratio(text):
     """
@@ -10,9 +99,7 @@ def english_words_ratio(text):
     Returns:
     float: The ratio of English words in the text.
     """
-    d = enchant.Dict("en_BG")
-    len_text = len(text.split())
-    return len([True for word in text.split() if d.check(word)]) / len_text
+    return get_analyzer().english_words_ratio(text)
 
 
 def unique_words_ratio(text, english_only=False):
@@ -26,12 +113,7 @@ def unique_words_ratio(text, english_only=False):
     Returns:
     - float: The ratio of unique words in the text.
     """
-    len_text = len(text.split())
-    if len_text <= 0: return 0
-    if english_only:
-        d = enchant.Dict("en_BG")
-        return len([True for word in text.split() if d.check(word)]) / len_text
-    return len(set(text.split())) / len_text
+    return get_analyzer().unique_words_ratio(text, english_only)
 
 
 def remove_non_english(text):
@@ -44,8 +126,129 @@ def remove_non_english(text):
     Returns:
         str: The text with non-English words removed.
     """
-    d = enchant.Dict("en_BG")
-    res = ""
-    for word in text.split(): 
-        res += f"{word} " if d.check(word) else ""
-    return res
\ No newline at end of file
+    return get_analyzer().remove_non_english(text)
+
+
+def _filter_chunk(lines):
+    return "".join(get_analyzer().filter_lines(lines))
+
+
+def _chunks(lines, chunk_lines):
+    lines = iter(lines)
+    while chunk := list(islice(lines, chunk_lines)):
+        yield chunk
+
+
+def stream_non_english(source, n_workers=1, chunk_lines=4096):
+    """
+    Removes non-English words from a large text, yielding the filtered text incrementally.
+
+    Args:
+        source (str or iterable): A file path, or an iterable of lines (e.g. an open file).
+        n_workers (int): If greater than 1, chunks of chunk_lines lines are filtered by a pool of processes, in order.
+            At most 2 * n_workers chunks are read ahead, so memory stays bounded.
+        chunk_lines (int): The number of lines per chunk.
+
+    Yields:
+        str: The filtered text, the concatenation of all the pieces is remove_non_english(text).
+    """
+    if isinstance(source, str):
+        with open(source, encoding="utf-8") as f:
+            yield from stream_non_english(f, n_workers, chunk_lines)
+        return
+
+    if n_workers <= 1:
+        for chunk in _chunks(source, chunk_lines):
+            yield _filter_chunk(chunk)
+        return
+    # pool.map would submit (and so read) every chunk up front, a bounded window of pending chunks is kept instead
+    chunks = _chunks(source, chunk_lines)
+    with ProcessPoolExecutor(n_workers) as pool:
+        pending = deque(pool.submit(_filter_chunk, chunk) for chunk in islice(chunks, 2 * n_workers))
+        while pending:
+            result = pending.popleft().result()
+            for chunk in islice(chunks, 1):
+                pending.append(pool.submit(_filter_chunk, chunk))
+            yield result
+
+
+def _check_words(words):
+    check = get_analyzer().check
+    return [check(word) for word in words]
+
+
+def score_texts(texts, n_workers=1, min_parallel_words=200000):
+    """
+    Computes english_words_ratio, unique_words_ratio and remove_non_english for many texts in one pass.
+
+    Every text is split once and every distinct word is checked once for the whole batch.
+    When there are at least min_parallel_words distinct words and n_workers is greater than 1,
+    the lookups are spread over a pool of processes.
+
+    Args:
+        texts (list of str): The texts, e.g. the samples generated by the RNN/LSTM/GRU models.
+        n_workers (int): The number of processes used for the dictionary lookups.
+        min_parallel_words (int): The number of distinct words from which the pool is used.
+
+    Returns:
+        pandas.DataFrame (or dict of numpy arrays without pandas): one row per text with the columns
+        n_words, english_words_ratio, unique_words_ratio and english_text.
+    """
+    tokenized = [text.split() for text in texts]
+    vocabulary = list(set().union(*tokenized))
+    if n_workers > 1 and len(vocabulary) >= min_parallel_words:
+        size = -(-len(vocabulary) // (n_workers * 4))
+        with ProcessPoolExecutor(n_workers) as pool:
+            checks = [ok for chunk in pool.map(_check_words, [vocabulary[i:i + size] for i in range(0, len(vocabulary), size)]) for ok in chunk]
+    else:
+        checks = _check_words(vocabulary)
+    valid = dict(zip(vocabulary, checks))
+
+    n_words = np.array([len(words) for words in tokenized])
+    n_english = np.array([sum(valid[word] for word in words) for words in tokenized])
+    n_unique = np.array([len(set(words)) for words in tokenized])
+    table = {
+        "n_words": n_words,
+        "english_words_ratio": n_english / np.maximum(n_words, 1),
+        "unique_words_ratio": n_unique / np.maximum(n_words, 1),
+        "english_text": np.array(["".join(f"{word} " for word in words if valid[word]) for words in tokenized], dtype=object),
+    }
+    return pd.DataFrame(table) if pandas_available else table
+
+
+if __name__ == "__main__":
+    # benchmark on wonderland.txt repeated --scale times
+    import argparse
+    import os
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="remove_non_english benchmark")
+    parser.add_argument("--text", default="wonderland.txt")
+    parser.add_argument("--scale", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with open(args.text, encoding="utf-8") as f:
+        text = f.read() * args.scale
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as f:
+        f.write(text)
+    print(f"{len(text) / 2 ** 20:.1f} MB, {len(text.split())} words")
+
+    def quadratic(text):
+        d = enchant.Dict("en_BG")
+        res = ""
+        for word in text.split():
+            res += f"{word} " if d.check(word) else ""
+        return res
+
+    results = {}
+    for name, run in [("loop", lambda: quadratic(text)),
+                      ("analyzer", lambda: TextAnalyzer().remove_non_english(text)),
+                      ("stream", lambda: "".join(stream_non_english(f.name))),
+                      (f"stream x{args.workers}", lambda: "".join(stream_non_english(f.name, n_workers=args.workers)))]:
+        start = time.perf_counter()
+        results[name] = run()
+        print(f"{name:>12}: {time.perf_counter() - start:.2f} s")
+    os.remove(f.name)
+    assert len(set(results.values())) == 1
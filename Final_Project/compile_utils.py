@@ -0,0 +1,62 @@
+import os
+import torch
+
+# Compiled execution shared by the notebook (main.py) and the hyperparameter tuning script (htuning.py).
+# backend 'inductor' runs the model through torch.compile, the compiled graphs are kept in an on-disk cache (cache_dir), so repeated runs with the
+# same architecture load them instead of compiling again. 'torchscript' is the fallback when torch.compile is not available (or fails), scripting
+# is cheap so it's simply redone; if scripting fails too the eager model is used. The compiled module shares the parameters of the eager one, so
+# optimizers and checkpoints keep using the eager model.
+# torch.compile is lazy, the graphs (and most failures, e.g. no C++ compiler for inductor on cpu) only come at the first call, and the training
+# graph only at the first backward. So with example_inputs the model is warmed up inside the fallback chain: a train mode forward + backward and
+# an eval mode forward, after which the buffers (batchnorm statistics), the gradients and the random state are restored as they were.
+
+
+def warm_up(model, compiled, example_inputs):
+    if example_inputs is None:
+        return
+    was_training = model.training
+    buffers = {name: b.detach().clone() for name, b in model.named_buffers()}
+    grads = {p: p.grad for p in model.parameters()}
+    devices = sorted({b.device.index for b in buffers.values() if b.is_cuda} | {p.device.index for p in grads if p.is_cuda})
+    try:
+        with torch.random.fork_rng(devices=devices):
+            model.train()
+            out = compiled(*example_inputs)
+            out = out[0] if isinstance(out, (tuple, list)) else out
+            if out.requires_grad:
+                out.float().mean().backward()
+            model.eval()
+            with torch.no_grad():
+                compiled(*example_inputs)
+    finally:
+        model.train(was_training)
+        with torch.no_grad():
+            for name, b in model.named_buffers():
+                b.copy_(buffers[name])
+        for p, grad in grads.items():
+            p.grad = grad
+
+
+def compile_model(model, backend='inductor', example_inputs=None, cache_dir='models/compile_cache'):
+    if backend is None:
+        return model
+    if backend == 'inductor':
+        try:
+            import torch._inductor.config
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+            torch._inductor.config.fx_graph_cache = True
+            compiled = torch.compile(model)
+            warm_up(model, compiled, example_inputs)
+            return compiled
+        except Exception as e:
+            print(f'torch.compile failed ({e}), falling back to torchscript')
+            backend = 'torchscript'
+    if backend == 'torchscript':
+        try:
+            compiled = torch.jit.script(model)
+            warm_up(model, compiled, example_inputs)
+            return compiled
+        except Exception as e:
+            print(f'torchscript failed ({e}), running the eager model')
+            return model
+    raise ValueError(f'unknown backend {backend}')
@@ -13,6 +13,7 @@ from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 import optuna
 from optuna.pruners import BasePruner
+from compile_utils import compile_model
     
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -184,7 +185,12 @@ class tinyNet(Module):
         x = self.fc2(x)
         return x
 
-def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writer, experiment_name, best_experiment_name, device='cuda'):
+# compilation of the trials is opt-in, 'inductor' or 'torchscript'. Every trial samples different layer widths, so inductor compiles every trial
+# again (the on-disk cache only helps when an architecture comes back), it pays off only for long trials
+compile_backend = None
+
+
+def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writer, experiment_name, best_experiment_name, device='cuda', compile_backend=None):
     train_loss = []
     val_loss = []
     train_acc = []
@@ -193,6 +199,8 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
     n_iter = 0
     best_acc = 0
     best_running_acc = 0
+    example_inputs = (next(iter(train_dl))[0].to(device),) if compile_backend is not None else None
+    step_model = compile_model(model, compile_backend, example_inputs)
     # ------------------------------ MODEL LOADING ------------------------------
     
     try:
@@ -236,7 +244,7 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
     
     for epoch in range(epochs):
         writer.add_scalar("epoch", epoch, n_iter)
-        model.train()
+        step_model.train()
         running_loss = 0.0
         correct = 0
         total = 0
@@ -247,7 +255,7 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
             inputs, labels = inputs.to(device), labels.to(device)
 
             optimizer.zero_grad()
-            outputs = model(inputs)
+            outputs = step_model(inputs)
             loss = criterion(outputs, labels)
             loss.backward()
             optimizer.step()
@@ -263,7 +271,7 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
         train_loss.append(running_loss/len(train_dl))
         train_acc.append(100*correct/total)
         
-        model.eval()
+        step_model.eval()
         running_loss = 0.0
         correct = 0
         total = 0
@@ -274,7 +282,7 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
                 inputs, labels = data
                 inputs, labels = inputs.to(device), labels.to(device)
                 
-                outputs = model(inputs)
+                outputs = step_model(inputs)
                 loss = criterion(outputs, labels)
                 
                 running_loss += loss.item()
@@ -372,7 +380,8 @@ def objective(trial):
                      writer=writer, 
                      experiment_name=experiment_name, 
                      best_experiment_name='tinyNetv2', 
-                     device=device)
+                     device=device,
+                     compile_backend=compile_backend)
     
     del model, optimizer, criterion, scheduler, writer, train_ds, val_ds, train_dl, val_dl
     torch.cuda.empty_cache()
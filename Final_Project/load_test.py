@@ -0,0 +1,92 @@
+import os
+import time
+import asyncio
+import argparse
+import numpy as np
+
+# Load test for serve.py, e.g.
+#   python load_test.py --images dataset/val_set --concurrency 1 4 16 64
+# Every client keeps one keep-alive connection open and sends its requests one after the other, the latency of each request is measured
+# from the moment it's written to the moment the whole response is read.
+
+
+async def open_connection(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def post_image(reader, writer, host, data, top_k):
+    writer.write(f'POST /predict?top_k={top_k} HTTP/1.1\r\n'
+                 f'Host: {host}\r\n'
+                 f'Content-Type: application/octet-stream\r\n'
+                 f'Content-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode('latin-1').split(':', 1)
+        if key.strip().lower() == 'content-length':
+            content_length = int(value)
+    await reader.readexactly(content_length)
+    return status
+
+
+async def client(args, images, n_requests, latencies, offset):
+    reader, writer = await open_connection(args)
+    try:
+        for i in range(n_requests):
+            data = images[(offset + i) % len(images)]
+            start = time.perf_counter()
+            status = await post_image(reader, writer, args.host, data, args.top_k)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                raise RuntimeError(f'request failed with status {status}')
+    finally:
+        writer.close()
+
+
+async def run_level(args, images, concurrency):
+    latencies = []
+    n_per_client = max(args.requests // concurrency, 1)
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, images, n_per_client, latencies, c * n_per_client) for c in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'p50_ms': np.percentile(latencies, 50),
+        'p99_ms': np.percentile(latencies, 99),
+        'throughput': len(latencies) / elapsed,
+    }
+
+
+async def main(args):
+    names = sorted(os.listdir(args.images))[:args.n_images]
+    images = [open(os.path.join(args.images, name), 'rb').read() for name in names]
+
+    # warmup, the first batches also pay for allocator and thread pool start up
+    await run_level(args, images, 1)
+
+    print(f"{'concurrency':>12} {'requests':>9} {'p50 (ms)':>10} {'p99 (ms)':>10} {'images/s':>10}")
+    for concurrency in args.concurrency:
+        r = await run_level(args, images, concurrency)
+        print(f"{r['concurrency']:>12} {r['requests']:>9} {r['p50_ms']:>10.2f} {r['p99_ms']:>10.2f} {r['throughput']:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='latency and throughput of serve.py at several concurrency levels')
+    parser.add_argument('--images', default='dataset/val_set')
+    parser.add_argument('--n-images', type=int, default=256, help='number of distinct images sent')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--top-k', type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -28,25 +28,37 @@ import torch.nn.functional as F
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import pandas as pd
 import pickle
+import json
+import hashlib
 import cv2
+import scipy.sparse as sp
+from scipy.cluster.hierarchy import linkage, leaves_list
 import gc
+import time
+import tracemalloc
+import multiprocessing as mp
 
 
 from torch.nn import Conv2d, MaxPool2d, Linear, ReLU, BatchNorm2d, Dropout, Flatten, Sequential, Module, GELU, LeakyReLU, BatchNorm2d
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import Dataset, DataLoader
-from sklearn.cluster import MiniBatchKMeans
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.cluster import MiniBatchKMeans, KMeans
 from sklearn.metrics import confusion_matrix
 from torchvision import transforms
-import seaborn as sns
 from PIL import Image
 from tqdm import tqdm
 from torchsummary import summary
 
-from sklearn.svm import SVC
+from sklearn.svm import SVC, LinearSVC
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.kernel_approximation import AdditiveChi2Sampler
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import Normalizer
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import train_test_split
 
@@ -236,16 +248,116 @@ class tinyNet(Module):
         x = self.conv3(x)
         x = self.conv4(x)
         x = self.conv5(x)
-        x = x.view(-1, 32*4*4)
+        x = x.reshape(-1, 32*4*4)
         x = self.fc1(x)
         x = self.fc2(x)
         return x
 
 
+# %%
+# compiled execution: compile_model(model, backend) returns the model compiled with 'inductor' (torch.compile, with an on-disk cache of the
+# compiled graphs) or 'torchscript', falling back to torchscript and then to the eager model if compiling fails. With example_inputs the train
+# and eval graphs are compiled (and any failure caught) there, without touching the weights, the batchnorm statistics or the gradients.
+# The implementation lives in compile_utils.py, shared with htuning.py
+from compile_utils import compile_model
+
+
+# %%
+# every run has one metrics file, a csv with a row per epoch preceded by a '# {...}' line holding the run metadata as json.
+# train() appends a row at the end of every epoch, so an interrupted run still has its curves, and the metadata can be read
+# without parsing the rows. Nothing is unpickled, the files load with pandas in a few ms.
+
+metric_columns = ['epoch', 'train_loss', 'val_loss', 'train_acc', 'val_acc', 'epoch_time', 'images_per_sec']
+
+def metrics_path(experiment_name, runs_dir='models'):
+    return os.path.join(runs_dir, experiment_name + '_metrics.csv')
+
+
+def run_has_rows(path):
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        f.readline(), f.readline()
+        return f.readline() != ''
+
+
+def init_run_metrics(path, meta, overwrite=False):
+    # the header is serialized first, so metadata that isn't json doesn't leave an emptied file behind, and an earlier run with the same
+    # experiment_name is never replaced silently (a header only file, a run killed in its first epoch, is)
+    header = '# ' + json.dumps(meta) + '\n' + ','.join(metric_columns) + '\n'
+    if not overwrite and run_has_rows(path):
+        raise FileExistsError(f'{path} already holds a run, use another experiment_name or overwrite=True')
+    with open(path, 'w') as f:
+        f.write(header)
+
+
+def append_run_metrics(path, row):
+    with open(path, 'a') as f:
+        f.write(','.join(str(row.get(c, '')) for c in metric_columns) + '\n')
+
+
+def read_run_meta(path):
+    with open(path) as f:
+        line = f.readline()
+    if not line.startswith('# '):
+        raise ValueError(f'{path} has no metadata line')
+    meta = json.loads(line[2:])
+    if not isinstance(meta, dict):
+        raise ValueError(f'{path} metadata is not a json object')
+    return meta
+
+
+def read_run_metrics(path):
+    return pd.read_csv(path, comment='#')
+
+
+def convert_legacy_pickles(experiment_name, src_dir='pickles', dst_dir='pickles'):
+    # the old runs stored one pickled list per metric, they have no timings
+    metrics = {}
+    for metric in ['train_loss', 'val_loss', 'train_acc', 'val_acc']:
+        with open(os.path.join(src_dir, f'{experiment_name}_{metric}.pkl'), 'rb') as f:
+            metrics[metric] = pickle.load(f)
+    path = metrics_path(experiment_name, dst_dir)
+    init_run_metrics(path, {'experiment_name': experiment_name, 'epochs': len(metrics['val_acc']), 'source': 'legacy pickles'}, overwrite=True)
+    for epoch in range(len(metrics['val_acc'])):
+        append_run_metrics(path, {'epoch': epoch, **{metric: values[epoch] for metric, values in metrics.items()}})
+    return path
+
+
 # %%
 # the train design is modular, the model, the dataloaders, the optimizer, the scheduler and the criterion are passed as arguments, the best model is saved in the models folder based on the experiment name
+# a batch can hold any number of inputs followed by the labels, (image, label) for tinyNet or (bow, image, label) for FoodBowCNN, the inputs are passed to the model in that order.
+# loss and accuracy are accumulated on the device and read back once per epoch (tensorboard gets the step loss every log_interval steps), so the loop doesn't wait for the gpu at every step.
+# precision is one of 'fp32', 'bf16' or 'fp16', the last two run under autocast, fp16 also uses gradient scaling.
+# with channels_last the model and the image batches are stored NHWC, which suits the many 3x3 convolutions with few channels of tinyNet on cpu
+
+precision_dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def unpack_batch(data, device, channels_last=False):
+    *inputs, labels = data
+    inputs = [x.to(device, non_blocking=True) for x in inputs]
+    if channels_last:
+        inputs = [x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x for x in inputs]
+    return inputs, labels.to(device, non_blocking=True)
+
+
+def validate(model, dl, criterion, device='cuda', precision='fp32', channels_last=False):
+    autocast_dtype = precision_dtypes[precision]
+    model.eval()
+    running_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
+    with torch.no_grad(), torch.autocast(device_type=torch.device(device).type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+        for data in dl:
+            inputs, labels = unpack_batch(data, device, channels_last)
+            outputs = model(*inputs)
+            running_loss += criterion(outputs, labels).float()
+            correct += (outputs.argmax(1) == labels).sum()
+            total += labels.size(0)
+    return running_loss.item()/len(dl), 100*correct.item()/total
 
-def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writer, experiment_name, best_experiment_name, device='cuda'):
+
+def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writer, experiment_name, best_experiment_name, device='cuda', precision='fp32', log_interval=25, channels_last=False, compile_backend=None, overwrite_metrics=False):
     train_loss = []
     val_loss = []
     train_acc = []
@@ -254,38 +366,39 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
     n_iter = 0
     best_acc = 0
     best_running_acc = 0
+    run_path = metrics_path(experiment_name)
+    init_run_metrics(run_path, {
+        'experiment_name': experiment_name,
+        'params': sum(p.numel() for p in model.parameters()),
+        'epochs': epochs,
+        'batch_size': train_dl.batch_size,
+        'optimizer': type(optimizer).__name__,
+        'precision': precision,
+        'device': str(device),
+        'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }, overwrite_metrics)
+    device_type = torch.device(device).type
+    autocast_dtype = precision_dtypes[precision]
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16' and device_type == 'cuda')
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    # the forward passes go through the compiled model (if any), the checkpoints keep the eager one
+    example_inputs = unpack_batch(next(iter(train_dl)), device, channels_last)[0] if compile_backend is not None else None
+    with torch.autocast(device_type=device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+        step_model = compile_model(model, compile_backend, example_inputs)
     # ------------------------------ MODEL LOADING ------------------------------
     
     try:
         checkpoint = torch.load(os.path.join('models', 'best_' + best_experiment_name + '.pth'))
         best_model = checkpoint['model']
-        best_optimizer = checkpoint['optimizer']
         best_criterion = checkpoint['criterion']
-        start_epoch = checkpoint['epoch'] + 1
         best_acc = checkpoint['best_acc']
         
         print('Best Model loaded, evaluating...')
         best_model.to(device)
-        best_model.eval()
-        running_loss = 0.0
-        correct = 0
-        total = 0
-        with torch.no_grad():
-            for i, data in enumerate(val_dl):
-                inputs, labels = data
-                inputs, labels = inputs.to(device), labels.to(device)
-
-                outputs = best_model(inputs)
-                loss = best_criterion(outputs, labels)
-
-                running_loss += loss.item()
-
-                _, predicted = torch.max(outputs.data, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-            print(f'Best model Loss: {running_loss/len(test_dl):.3f}, Test Acc: {100*correct/total:.3f}%')
-            best_acc = 100*correct/total
-        del best_model, best_criterion, best_optimizer, checkpoint
+        best_loss, best_acc = validate(best_model, val_dl, best_criterion, device, precision, channels_last)
+        print(f'Best model Loss: {best_loss:.3f}, Test Acc: {best_acc:.3f}%')
+        del best_model, best_criterion, checkpoint
         torch.cuda.empty_cache()
         gc.collect()
         
@@ -297,58 +410,48 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
     
     for epoch in range(epochs):
         writer.add_scalar("epoch", epoch, n_iter)
-        model.train()
-        running_loss = 0.0
-        correct = 0
+        step_model.train()
+        running_loss = torch.zeros((), device=device)
+        correct = torch.zeros((), dtype=torch.long, device=device)
         total = 0
+        epoch_start = time.perf_counter()
         
         # ------------------------------ TRAINING LOOP ------------------------------
         for i, data in enumerate(train_dl):
-            inputs, labels = data
-            inputs, labels = inputs.to(device), labels.to(device)
+            inputs, labels = unpack_batch(data, device, channels_last)
 
             optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            running_loss += loss.item()
+            with torch.autocast(device_type=device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                outputs = step_model(*inputs)
+                loss = criterion(outputs, labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            if scheduler is not None:
+                scheduler.step()
+            running_loss += loss.detach().float()
             
-            _, predicted = torch.max(outputs.data, 1)
+            correct += (outputs.argmax(1) == labels).sum()
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-            writer.add_scalar("train", loss.item(), n_iter)
+            if n_iter % log_interval == 0:
+                writer.add_scalar("train", loss.item(), n_iter)
             n_iter += 1
             
-        train_loss.append(running_loss/len(train_dl))
-        train_acc.append(100*correct/total)
-        
-        model.eval()
-        running_loss = 0.0
-        correct = 0
+        train_loss.append(running_loss.item()/len(train_dl))
+        train_acc.append(100*correct.item()/total)
+        train_time = time.perf_counter() - epoch_start
         
         # ------------------------------ VALIDATION LOOP ------------------------------
-        with torch.no_grad():
-            for i, data in enumerate(val_dl):
-                inputs, labels = data
-                inputs, labels = inputs.to(device), labels.to(device)
-                
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
-                
-                running_loss += loss.item()
-                
-                _, predicted = torch.max(outputs.data, 1)
-                correct += (predicted == labels).sum().item()
-                writer.add_scalar("val", loss.item(), n_iter)
+        epoch_val_loss, epoch_val_acc = validate(step_model, val_dl, criterion, device, precision, channels_last)
+        writer.add_scalar("val", epoch_val_loss, n_iter)
         
         # ------------------------------ PRINTING AND MODEL SAVING ------------------------------
-        pbar.set_description(f'Epoch: {epoch+1}/{epochs}, Train Loss: {train_loss[-1]:.3f}, Train Acc: {train_acc[-1]:.3f}%, Val Loss: {running_loss/len(val_dl):.3f}, Val Acc: {100*correct/len(val_ds):.3f}%, Acc to beat: {best_acc:.3f}%')
-        val_loss.append(running_loss/len(val_dl))
-        val_acc.append(100*correct/len(val_ds))
+        val_loss.append(epoch_val_loss)
+        val_acc.append(epoch_val_acc)
+        append_run_metrics(run_path, {'epoch': epoch, 'train_loss': train_loss[-1], 'val_loss': val_loss[-1], 'train_acc': train_acc[-1], 'val_acc': val_acc[-1],
+                                      'epoch_time': time.perf_counter() - epoch_start, 'images_per_sec': total / train_time})
+        pbar.set_description(f'Epoch: {epoch+1}/{epochs}, Train Loss: {train_loss[-1]:.3f}, Train Acc: {train_acc[-1]:.3f}%, Val Loss: {val_loss[-1]:.3f}, Val Acc: {val_acc[-1]:.3f}%, Acc to beat: {best_acc:.3f}%')
         if val_acc[-1] > best_running_acc:
-            pbar.set_description(f'Epoch: {epoch+1}/{epochs}, Train Loss: {train_loss[-1]:.3f}, Train Acc: {train_acc[-1]:.3f}%, Val Loss: {running_loss/len(val_dl):.3f}, Val Acc: {100*correct/len(val_ds):.3f}%, Acc to beat: {best_acc:.3f}%')
             best_running_acc = val_acc[-1]
             checkpoint = {
                 'model': model,
@@ -363,15 +466,6 @@ def train(model, train_dl, val_dl, optimizer, scheduler, criterion, epochs, writ
         pbar.update(1)
     pbar.close()
     
-    with open(os.path.join('models', experiment_name + '_train_loss.pkl'), 'wb') as f:
-        pickle.dump(train_loss, f)
-    with open(os.path.join('models', experiment_name + '_val_loss.pkl'), 'wb') as f:
-        pickle.dump(val_loss, f)
-    with open(os.path.join('models', experiment_name + '_train_acc.pkl'), 'wb') as f:
-        pickle.dump(train_acc, f)
-    with open(os.path.join('models', experiment_name + '_val_acc.pkl'), 'wb') as f:
-        pickle.dump(val_acc, f)
-    
     return val_acc
 
 # %%
@@ -406,12 +500,164 @@ train(model = model,
       best_experiment_name = experiment_name,
       device = device)
 
+# %%
+# cpu execution config: torch uses one intra-op thread per core by default, and each DataLoader worker is a separate process decoding and augmenting images,
+# running both at full width oversubscribes the cores. configure_cpu_threads leaves num_workers cores to the loader and one inter-op thread
+# (tinyNet is a plain chain of layers, there are no independent branches to run in parallel). set_num_interop_threads can only be called once per process
+
+def configure_cpu_threads(num_workers, intra_op_threads=None, inter_op_threads=1):
+    intra_op_threads = intra_op_threads or max(1, os.cpu_count() - num_workers)
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        pass
+    return intra_op_threads
+
+
+# average training step time (forward + backward + optimizer step) on a random batch, for every combination of memory format and intra-op threads
+def benchmark_cpu_configs(make_model, batch_size=128, n_steps=20, thread_counts=None):
+    thread_counts = thread_counts or sorted({1, os.cpu_count() // 2, os.cpu_count()} - {0})
+    images = torch.randn(batch_size, 3, 128, 128)
+    labels = torch.randint(0, 251, (batch_size,))
+    criterion = torch.nn.CrossEntropyLoss()
+    default_threads = torch.get_num_threads()
+    rows = []
+    for channels_last in [False, True]:
+        for n_threads in thread_counts:
+            torch.set_num_threads(n_threads)
+            model = make_model().train()
+            x = images
+            if channels_last:
+                model.to(memory_format=torch.channels_last)
+                x = images.contiguous(memory_format=torch.channels_last)
+            optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+            for i in range(n_steps + 2):
+                if i == 2:  # two warmup steps
+                    start = time.perf_counter()
+                optimizer.zero_grad()
+                criterion(model(x), labels).backward()
+                optimizer.step()
+            step_time = (time.perf_counter() - start) / n_steps
+            rows.append({'channels_last': channels_last, 'threads': n_threads, 'ms/step': 1000 * step_time, 'images/s': batch_size / step_time})
+    torch.set_num_threads(default_threads)
+    return pd.DataFrame(rows)
+
+
+benchmark_cpu_configs(lambda: tinyNet(c1_filters=16, c2_filters=70, c3_filters=140, c4_filters=140, c5_filters=32, fc1_units=347))
+
+# %%
+# e.g. for cpu training with the 8 loader workers used above
+# configure_cpu_threads(num_workers=8)
+# train(..., device='cpu', channels_last=True)
+
+# %%
+# test time augmentation: the views of a batch (the flips of augmentation_train, optionally the 90 degrees rotations that RandomAffine(degrees=90) can produce)
+# are stacked into a single batch of len(views) * batch_size images, so the model still runs once per batch, then the logits of the views are averaged
+
+tta_views = {
+    'identity': lambda x: x,
+    'hflip': lambda x: x.flip(3),
+    'vflip': lambda x: x.flip(2),
+    'hvflip': lambda x: x.flip(2, 3),
+    'rot90': lambda x: x.rot90(1, (2, 3)),
+    'rot270': lambda x: x.rot90(3, (2, 3)),
+}
+
+def tta_forward(net, x, views=('identity', 'hflip', 'vflip', 'hvflip')):
+    out = net(torch.cat([tta_views[view](x) for view in views]))
+    return out.view(len(views), x.size(0), -1).mean(0)
+
+
+# accuracy and forward time per image for every set of views, the gain is measured against the first set (which should be ('identity',))
+def tta_report(net, test_loader, view_sets):
+    net.eval()
+    rows = []
+    for views in view_sets:
+        correct = 0
+        forward_time = 0
+        with torch.no_grad():
+            for el, labels in test_loader:
+                el, labels = el.to(device), labels.to(device)
+                start = time.perf_counter()
+                out = tta_forward(net, el, views)
+                if el.is_cuda:
+                    torch.cuda.synchronize()
+                forward_time += time.perf_counter() - start
+                correct += (out.argmax(1) == labels).sum().item()
+        rows.append({'views': '+'.join(views), 'accuracy': 100 * correct / len(test_loader.dataset), 'ms/image': 1000 * forward_time / len(test_loader.dataset)})
+    report = pd.DataFrame(rows)
+    report['accuracy gain'] = report['accuracy'] - report['accuracy'].iloc[0]
+    report['gain per extra ms/image'] = report['accuracy gain'] / (report['ms/image'] - report['ms/image'].iloc[0])
+    return report
+
+
+# %%
+# the confusion matrix of the 251 classes is drawn as a single image with a tick every tick_step classes, which takes a fraction of a second
+# instead of the minutes (and GBs) of a heatmap with 63k cells and every label. With normalize the rows sum to 1 (the recall is on the diagonal),
+# with reorder the classes are sorted by hierarchical clustering of their confusion rows, so classes that get mixed up end up next to each other
+
+def row_normalize(cm):
+    cm = np.asarray(cm, dtype=float)
+    return cm / np.maximum(cm.sum(1, keepdims=True), 1)
+
+
+def cluster_order(cm):
+    cm = row_normalize(cm)
+    return leaves_list(linkage((cm + cm.T) / 2, method='average'))
+
+
+def most_confused_pairs(cm, class_names, top_n=20, normalize=True):
+    off_diagonal = row_normalize(cm) if normalize else np.array(cm, dtype=float)
+    np.fill_diagonal(off_diagonal, 0)
+    flat = off_diagonal.ravel()
+    top = np.argpartition(flat, -top_n)[-top_n:]
+    top = top[np.argsort(flat[top])[::-1]]
+    actual, predicted = np.unravel_index(top, off_diagonal.shape)
+    class_names = np.asarray(class_names)
+    return pd.DataFrame({'actual': class_names[actual], 'predicted': class_names[predicted], 'rate' if normalize else 'count': flat[top]})
+
+
+def plot_confusion_matrix(cm, class_names, normalize=True, reorder=False, tick_step=10, figsize=(16, 14), save_path=None, show=True):
+    cm = row_normalize(cm) if normalize else np.asarray(cm)
+    class_names = np.asarray(class_names)
+    if reorder:
+        order = cluster_order(cm)
+        cm, class_names = cm[order][:, order], class_names[order]
+
+    fig, ax = plt.subplots(figsize=figsize)
+    image = ax.imshow(cm, cmap='viridis', interpolation='nearest', aspect='auto')
+    fig.colorbar(image, ax=ax)
+    ticks = np.arange(0, len(class_names), tick_step)
+    ax.set_xticks(ticks)
+    ax.set_xticklabels(class_names[ticks], rotation=90, fontsize=8)
+    ax.set_yticks(ticks)
+    ax.set_yticklabels(class_names[ticks], fontsize=8)
+    ax.set_xlabel('Predicted')
+    ax.set_ylabel('Actual')
+    if save_path is not None:
+        fig.savefig(save_path, dpi=150, bbox_inches='tight')
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
+    return fig
+
+
 # %%
 # this plot is hard to  visualize because of the number of classes, but it's useful to see the training progress
 import torchmetrics as tm
 
-def evaluate_model(net, test_loader):
+def evaluate_model(net, test_loader, tta=None, channels_last=False, compile_backend=None, reorder=False, cm_path=None):
     
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+    example_inputs = None
+    if compile_backend is not None:
+        example_inputs = (next(iter(test_loader))[0].to(device),)
+        if channels_last:
+            example_inputs = (example_inputs[0].contiguous(memory_format=torch.channels_last),)
+    net = compile_model(net, compile_backend, example_inputs)
     net.eval()
     gt = []
     pred = []
@@ -429,8 +675,10 @@ def evaluate_model(net, test_loader):
     with torch.no_grad():
         for el, labels in test_loader:
             el = el.to(device)
+            if channels_last:
+                el = el.contiguous(memory_format=torch.channels_last)
             labels = labels.to(device)
-            out = net(el)
+            out = tta_forward(net, el, tta) if tta else net(el)
             _, predicted = torch.max(out, 1)
 
             micro_acc.update(predicted, labels)
@@ -456,16 +704,19 @@ def evaluate_model(net, test_loader):
           Old accuracy: {correct}
           """)
     
-    cm = confusion_matrix(gt, pred)
-    plt.figure(figsize=(50, 40))
-    sns.heatmap(cm, annot=False, fmt='g', cmap='viridis', xticklabels=class_list['name'].values, yticklabels=class_list['name'].values)
-    plt.xlabel('Predicted')
-    plt.ylabel('Actual')
-    plt.show()
+    cm = confusion_matrix(gt, pred, labels=np.arange(len(class_list)))
+    plot_confusion_matrix(cm, class_list['name'].values, reorder=reorder, save_path=cm_path)
+    print(most_confused_pairs(cm, class_list['name'].values, top_n=10).to_string(index=False))
 
 model = torch.load('models/best_tinynet_sslv2.pth')['model']
 evaluate_model(model, val_dl)
 
+# %%
+tta_report(model, val_dl, [('identity',),
+                           ('identity', 'hflip'),
+                           ('identity', 'hflip', 'vflip', 'hvflip'),
+                           ('identity', 'hflip', 'vflip', 'hvflip', 'rot90', 'rot270')])
+
 
 # %% [markdown]
 # ----
@@ -698,7 +949,10 @@ plt.show()
 # %%
 # this is a simple training loop for the SSL
 
-def train_ssl(model, ssl_dl, optimizer, loss, epochs, device, experiment_name):
+def train_ssl(model, ssl_dl, optimizer, loss, epochs, device, experiment_name, compile_backend=None):
+    # the forward passes go through the compiled model (if any), the saved model is the eager one
+    example_inputs = (next(iter(ssl_dl))[1].to(device),) if compile_backend is not None else None
+    step_model = compile_model(model, compile_backend, example_inputs)
     model.train()
     train_loss = []
     train_loss_mean = []
@@ -711,7 +965,7 @@ def train_ssl(model, ssl_dl, optimizer, loss, epochs, device, experiment_name):
             clean, noisy = data
             clean, noisy = clean.to(device), noisy.to(device)
             optimizer.zero_grad()
-            noisy_out = model(noisy)
+            noisy_out = step_model(noisy)
             loss_out = loss(noisy_out, clean)
             loss_out.backward()
             optimizer.step()
@@ -750,7 +1004,8 @@ train_ssl(model=ssl_model,
           loss=ssl_loss,
           epochs=20,
           device=device,
-          experiment_name=experiment_name)
+          experiment_name=experiment_name,
+          compile_backend=None)
 
 # %%
 experiment_name = 'tinynetClassicv2'
@@ -921,9 +1176,14 @@ criterion_L1 = nn.L1Loss()
 optimizer_G = optim.Adam(generator.parameters(), lr=0.0002, betas=(0.5, 0.999))
 optimizer_D = optim.Adam(discriminator.parameters(), lr=0.0002, betas=(0.5, 0.999))
 
-# Training loop
+# Training loop, set gan_compile_backend to 'inductor' or 'torchscript' to train through the compiled generator and discriminator
+# (the eager modules keep the weights, the optimizers work on them)
 
 num_epochs = 50
+gan_compile_backend = None
+example_clean, example_noisy = next(iter(ssl_dl)) if gan_compile_backend is not None else (None, None)
+generator_step = compile_model(generator, gan_compile_backend, example_inputs=(example_noisy,))
+discriminator_step = compile_model(discriminator, gan_compile_backend, example_inputs=(example_clean,))
 
 for epoch in range(num_epochs):
     for i, (images, noisy_images) in enumerate(ssl_dl):
@@ -931,12 +1191,12 @@ for epoch in range(num_epochs):
         generator.zero_grad()
         
         # Generate reconstructed images
-        reconstructed_images = generator(noisy_images)
+        reconstructed_images = generator_step(noisy_images)
         
         # Adversarial loss
         valid = torch.ones(images.size(0), 1, requires_grad=False)
         fake = torch.zeros(images.size(0), 1, requires_grad=False)
-        g_loss_adv = criterion_GAN(discriminator(reconstructed_images), valid)
+        g_loss_adv = criterion_GAN(discriminator_step(reconstructed_images), valid)
         
         # L1 loss
         g_loss_l1 = criterion_L1(reconstructed_images, images)
@@ -951,10 +1211,10 @@ for epoch in range(num_epochs):
         discriminator.zero_grad()
         
         # Real loss
-        real_loss = criterion_GAN(discriminator(images), valid)
+        real_loss = criterion_GAN(discriminator_step(images), valid)
         
         # Fake loss
-        fake_loss = criterion_GAN(discriminator(reconstructed_images.detach()), fake)
+        fake_loss = criterion_GAN(discriminator_step(reconstructed_images.detach()), fake)
         
         # Total discriminator loss
         d_loss = (real_loss + fake_loss) / 2
@@ -966,6 +1226,32 @@ for epoch in range(num_epochs):
         print(f"Epoch [{epoch+1}/{num_epochs}], Batch [{i+1}/{len(ssl_dl)}], "
               f"G Loss: {g_loss.item():.4f}, D Loss: {d_loss.item():.4f}")
 
+# %%
+# eager vs compiled time of a training step (forward + backward) for the classifier and the ssl autoencoders, the compile time is the first call with
+# example inputs, which also fills the cache used by the following runs
+
+def benchmark_compiled(make_model, backend, batch_size=32, n_steps=10):
+    model = make_model().to(device).train()
+    x = torch.randn(batch_size, 3, 128, 128, device=device)
+    start = time.perf_counter()
+    compiled = compile_model(model, backend, example_inputs=(x,))  # the warm up also compiles the backward graph
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        model.zero_grad()
+        compiled(x).float().mean().backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return compile_time, 1000 * (time.perf_counter() - start) / n_steps
+
+rows = []
+for name, make_model in [('tinyNet', tinyNet), ('SSL_RandomErasing', SSL_RandomErasing), ('Generator', Generator)]:
+    _, eager_ms = benchmark_compiled(make_model, None)
+    for backend in ['inductor', 'torchscript']:
+        compile_time, compiled_ms = benchmark_compiled(make_model, backend)
+        rows.append({'model': name, 'backend': backend, 'compile + warmup (s)': compile_time, 'eager ms/step': eager_ms, 'compiled ms/step': compiled_ms, 'speedup': eager_ms / compiled_ms})
+pd.DataFrame(rows)
+
 # %% [markdown]
 # ----
 # # <center>Transfer Learning from SSL
@@ -997,6 +1283,135 @@ train(model=tinynet,
         best_experiment_name=experiment_name + '_ssl',
         device=device)
 
+# %%
+# staged transfer learning: instead of fine-tuning the whole encoder from epoch 0, the first `frozen_blocks` conv blocks are frozen and their outputs
+# are computed once on the non-augmented training set and stored on disk, the upper blocks and the fully connected layers are then trained directly
+# from the cached activations, so the early epochs skip the most expensive part of the network (the high resolution blocks) in both passes
+
+class CachedActivationsDataset(Dataset):
+    def __init__(self, activations, labels):
+        self.activations = activations
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        activation = torch.from_numpy(self.activations[idx].astype(np.float32))
+        return activation, self.labels[idx]
+
+
+# the upper part of a tinyNet, starting from block `frozen_blocks + 1`, the modules are shared with the encoder so training this updates the encoder in place
+class tinyNetUpper(Module):
+    def __init__(self, encoder, frozen_blocks):
+        super(tinyNetUpper, self).__init__()
+        self.blocks = Sequential(*[getattr(encoder, f'conv{i}') for i in range(frozen_blocks + 1, 6)])
+        self.fc1 = encoder.fc1
+        self.fc2 = encoder.fc2
+
+    def forward(self, x):
+        x = self.blocks(x)
+        x = x.reshape(-1, 32*4*4)
+        x = self.fc1(x)
+        x = self.fc2(x)
+        return x
+
+
+def freeze_blocks(encoder, frozen_blocks, freeze=True):
+    for i in range(1, frozen_blocks + 1):
+        block = getattr(encoder, f'conv{i}')
+        for p in block.parameters():
+            p.requires_grad = not freeze
+
+
+# the activations are stored as float16 in a .npy file which is memory mapped, the first blocks work at high resolution so the cache can be large.
+# the file name gets a hash of the frozen weights, so a retrained encoder never reuses old activations, and the file is written under a
+# .tmp name and renamed only when complete, so an interrupted run leaves nothing that looks like a valid cache
+def weights_hash(module, length=10):
+    h = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()[:length]
+
+
+def cache_activations(encoder, df, root_dir, frozen_blocks, cache_path, batch_size=256, device='cuda', force_recompute=False):
+    labels = df['label'].values
+    frozen = Sequential(*[getattr(encoder, f'conv{i}') for i in range(1, frozen_blocks + 1)]).to(device)
+    frozen.eval()
+    cache_path = f'{os.path.splitext(cache_path)[0]}_{weights_hash(frozen)}.npy'
+    if os.path.exists(cache_path) and not force_recompute:
+        return CachedActivationsDataset(np.load(cache_path, mmap_mode='r'), labels)
+
+    dl = DataLoader(FoodDataset(df, root_dir, transform_val), batch_size=batch_size, shuffle=False, num_workers=8)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    activations = None
+    idx = 0
+    with torch.no_grad():
+        for inputs, _ in tqdm(dl, desc=f'caching conv1..conv{frozen_blocks}'):
+            out = frozen(inputs.to(device)).half().cpu().numpy()
+            if activations is None:
+                activations = np.lib.format.open_memmap(cache_path + '.tmp', mode='w+', dtype=np.float16, shape=(len(df),) + out.shape[1:])
+            activations[idx:idx + len(out)] = out
+            idx += len(out)
+    activations.flush()
+    del activations
+    os.replace(cache_path + '.tmp', cache_path)
+    return CachedActivationsDataset(np.load(cache_path, mmap_mode='r'), labels)
+
+
+# %%
+experiment_name = 'tinynetClassicv2'
+frozen_blocks = 2
+staged_epochs = 30
+epochs = 150
+
+ssl_model_ = torch.load(f'models/ssl/ssl_{experiment_name}.pth')
+tinynet = ssl_model_.encoder.to(device)
+
+# stage 1: frozen conv1..convK, upper blocks trained on cached activations
+freeze_blocks(tinynet, frozen_blocks)
+cached_train_ds = cache_activations(tinynet, train_df, 'dataset/train_set', frozen_blocks, f'dataset/cache/{experiment_name}_train_k{frozen_blocks}.npy', device=device)
+cached_val_ds = cache_activations(tinynet, val_df, 'dataset/val_set', frozen_blocks, f'dataset/cache/{experiment_name}_val_k{frozen_blocks}.npy', device=device)
+cached_train_dl = DataLoader(cached_train_ds, batch_size=128, shuffle=True, num_workers=8)
+cached_val_dl = DataLoader(cached_val_ds, batch_size=128, shuffle=False, num_workers=8)
+
+upper = tinyNetUpper(tinynet, frozen_blocks)
+optimizer = torch.optim.AdamW([p for p in upper.parameters() if p.requires_grad], lr=0.001)
+criterion = torch.nn.CrossEntropyLoss()
+writer = SummaryWriter('runs/tinynet_ssl_staged')
+scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, staged_epochs * len(cached_train_dl), eta_min=0.0001)
+
+train(model=upper,
+        train_dl=cached_train_dl,
+        val_dl=cached_val_dl,
+        optimizer=optimizer,
+        criterion=criterion,
+        scheduler=scheduler,
+        epochs=staged_epochs,
+        writer=writer,
+        experiment_name=experiment_name + '_ssl_staged_upper',
+        best_experiment_name=experiment_name + '_ssl_staged_upper',
+        device=device)
+
+# stage 2: everything is unfrozen and the whole encoder is fine-tuned on the augmented images for the remaining epochs
+freeze_blocks(tinynet, frozen_blocks, freeze=False)
+optimizer = torch.optim.AdamW(tinynet.parameters(), lr=0.0005)
+scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(optimizer, T_0=50, T_mult=1)
+
+train(model=tinynet,
+        train_dl=train_dl,
+        val_dl=val_dl,
+        optimizer=optimizer,
+        criterion=criterion,
+        scheduler=scheduler,
+        epochs=epochs - staged_epochs,
+        writer=writer,
+        experiment_name=experiment_name + '_ssl_staged',
+        best_experiment_name=experiment_name + '_ssl_staged',
+        device=device)
+
 # %%
 evaluate_model(tinynet, val_dl)
 
@@ -1006,12 +1421,146 @@ evaluate_model(tinynet, val_dl)
 # For the implementation of the hyperparameter tuning refer to the script `htuning.py`, we opted to write it in a separate script as jupyter notebook doesn't free memory in certain critical circumstances.<br>
 # The hyperparameter tuning starts from line 308, the previous lines are just a redefinition of the network and datasets as done in the previous sections.
 
+# %% [markdown]
+# ----
+# # <center> Channel pruning
+# Instead of searching the filter counts again from scratch, a trained `tinyNet` can be shrunk: the filters of `conv1`..`conv5` (and the units of `fc1`) are ranked by importance, the least important ones are physically removed and the smaller network is fine-tuned for a few epochs.
+
+# %%
+# importance of the filters: for the convolutions followed by batch norm it's |gamma| (a filter scaled to ~0 by bn contributes nothing),
+# for the others the L1 norm of the filter weights. Every block of tinyNet is conv_a -> conv_b -> bn, the output width of conv_a is tied to the
+# input width of the block by the constructor, but which filters are kept is chosen independently. conv5 always keeps its 32 filters, fc1 depends on it
+
+def filter_importance(layer, bn=None):
+    if bn is not None:
+        return bn.weight.detach().abs()
+    return layer.weight.detach().abs().flatten(1).sum(1)
+
+
+def keep_top(importance, n):
+    return importance.argsort(descending=True)[:n].sort().values
+
+
+def copy_pruned(dst, src, out_idx, in_idx=None):
+    weight = src.weight.data[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    dst.weight.data.copy_(weight)
+    if getattr(src, 'bias', None) is not None:
+        dst.bias.data.copy_(src.bias.data[out_idx])
+    if isinstance(src, BatchNorm2d):
+        dst.running_mean.copy_(src.running_mean[out_idx])
+        dst.running_var.copy_(src.running_var[out_idx])
+        dst.num_batches_tracked.copy_(src.num_batches_tracked)
+
+
+def tinynet_widths(model):
+    return {'c1_filters': model.conv1[0].out_channels,
+            'c2_filters': model.conv1[2].out_channels,
+            'c3_filters': model.conv2[2].out_channels,
+            'c4_filters': model.conv3[2].out_channels,
+            'c5_filters': model.conv4[2].out_channels,
+            'fc1_units': model.fc1[0].out_features}
+
+
+def prune_tinynet(model, ratio=None, **widths):
+    model = model.cpu()
+    current = tinynet_widths(model)
+    if ratio is not None:
+        widths = {k: max(1, int(round(v * ratio))) for k, v in current.items()}
+    widths = {k: min(widths.get(k, v), v) for k, v in current.items()}
+    pruned = tinyNet(**widths)
+
+    conv_a_widths = [widths['c1_filters'], widths['c2_filters'], widths['c3_filters'], widths['c4_filters'], widths['c5_filters']]
+    conv_b_widths = [widths['c2_filters'], widths['c3_filters'], widths['c4_filters'], widths['c5_filters'], 32]
+    in_idx = torch.arange(3)
+    for b in range(5):
+        src, dst = getattr(model, f'conv{b+1}'), getattr(pruned, f'conv{b+1}')
+        a_idx = keep_top(filter_importance(src[0]), conv_a_widths[b])
+        copy_pruned(dst[0], src[0], a_idx, in_idx)
+        b_idx = keep_top(filter_importance(src[2], src[3]), conv_b_widths[b])
+        copy_pruned(dst[2], src[2], b_idx, a_idx)
+        copy_pruned(dst[3], src[3], b_idx)
+        in_idx = b_idx
+
+    # conv5 keeps all its filters (sorted), so the input of fc1 is unchanged
+    units = keep_top(filter_importance(model.fc1[0]), widths['fc1_units'])
+    copy_pruned(pruned.fc1[0], model.fc1[0], units, torch.arange(32*4*4))
+    pruned.fc2[0].weight.data.copy_(model.fc2[0].weight.data[:, units])
+    pruned.fc2[0].bias.data.copy_(model.fc2[0].bias.data)
+    return pruned
+
+
+# the largest uniform ratio whose pruned network fits in max_params, found by bisection
+def prune_to_budget(model, max_params, tolerance=0.005):
+    current = tinynet_widths(model)
+    low, high = 0.0, 1.0
+    while high - low > tolerance:
+        ratio = (low + high) / 2
+        widths = {k: max(1, int(round(v * ratio))) for k, v in current.items()}
+        if sum(p.numel() for p in tinyNet(**widths).parameters()) <= max_params:
+            low = ratio
+        else:
+            high = ratio
+    return prune_tinynet(model, ratio=max(low, tolerance))
+
+
+def measure_latency(model, batch_size=1, n_runs=50):
+    model = model.cpu().eval()
+    x = torch.randn(batch_size, 3, 128, 128)
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            model(x)
+    return 1000 * (time.perf_counter() - start) / n_runs
+
+
+# %%
+experiment_name = 'tinyNetClassic'
+max_params = 500000
+
+trained = torch.load(f'models/best_{experiment_name}.pth', map_location='cpu')['model']
+pruned = prune_to_budget(trained, max_params)
+
+print(f'original: {tinynet_widths(trained)}, {sum(p.numel() for p in trained.parameters())} parameters, {measure_latency(trained):.2f} ms/image')
+print(f'pruned:   {tinynet_widths(pruned)}, {sum(p.numel() for p in pruned.parameters())} parameters, {measure_latency(pruned):.2f} ms/image')
+
+# %%
+# short fine-tuning of the pruned network
+
+pruned = pruned.to(device)
+optimizer = torch.optim.Adam(pruned.parameters(), lr=0.0005)
+criterion = torch.nn.CrossEntropyLoss()
+epochs = 5
+writer = SummaryWriter('runs/' + experiment_name + '_pruned')
+scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs * len(train_dl), eta_min=0.00005)
+
+train(model=pruned,
+      train_dl=train_dl,
+      val_dl=val_dl,
+      optimizer=optimizer,
+      criterion=criterion,
+      scheduler=scheduler,
+      epochs=epochs,
+      writer=writer,
+      experiment_name=experiment_name + '_pruned',
+      best_experiment_name=experiment_name + '_pruned',
+      device=device)
+
+# %% [markdown]
+# ----
+# # <center> Serving
+# `serve.py` is a local inference server, it loads a `tinyNet` checkpoint once and batches concurrent requests together (up to `--max-batch-size` images, waiting at most `--max-latency-ms` for a batch to fill), `POST /predict?top_k=5` with the image as the body returns the top-k classes of `class_list`.<br>
+# `load_test.py` measures p50/p99 latency and throughput of the server at several concurrency levels.
+# `predict.py` runs a checkpoint over the whole unlabeled `dataset/test_set` and writes the predictions to a csv in the order of `test_info.csv`, an interrupted run resumes from the rows already written.
+
 # %% [markdown]
 # ----
 # # <center>Plots
 
 # %% [markdown]
-# The data regarding the accuracy and loss during training is stored under the directory `pickles`.<br>
+# The data regarding the accuracy and loss during training is stored under the directory `pickles`, one `{experiment_name}_metrics.csv` per run (new runs are written by `train` to `models`).<br>
 # The naming convetion is as follows:
 #
 # - `tinyNetClassic`: refers to the network without hyperparameter tuning and without SSL pretraining <br>
@@ -1025,10 +1574,10 @@ evaluate_model(tinynet, val_dl)
 experiment_name = 'tinyNetClassic'
 fontsize = 18
 
-train_acc = pickle.load(open(f'pickles/{experiment_name}_train_acc.pkl', 'rb'))
-val_acc = pickle.load(open(f'pickles/{experiment_name}_val_acc.pkl', 'rb'))
-train_loss = pickle.load(open(f'pickles/{experiment_name}_train_loss.pkl', 'rb'))
-val_loss = pickle.load(open(f'pickles/{experiment_name}_val_loss.pkl', 'rb'))
+# the runs trained before the metrics files existed can be converted with convert_legacy_pickles(experiment_name)
+run_metrics = read_run_metrics(metrics_path(experiment_name, 'pickles'))
+train_acc, val_acc = run_metrics['train_acc'], run_metrics['val_acc']
+train_loss, val_loss = run_metrics['train_loss'], run_metrics['val_loss']
 
 plt.figure(figsize=(25, 10))
 
@@ -1055,6 +1604,83 @@ plt.yticks(fontsize=fontsize)
 plt.show()
 
 
+# %% [markdown]
+# ### Comparing runs
+# `index_runs` lists every `*_metrics.csv` in `pickles` and `models` reading only the metadata line, the curves are read when a run is summarized or plotted and kept in memory until the file changes.
+# All the curves of a plot are drawn as a single `LineCollection`, so overlaying hundreds of runs stays fast.
+
+# %%
+_run_cache = {}
+
+def load_run(path):
+    key = (path, os.path.getmtime(path))
+    if key not in _run_cache:
+        _run_cache[key] = read_run_metrics(path)
+    return _run_cache[key]
+
+
+def index_runs(runs_dirs=('pickles', 'models')):
+    rows = []
+    for runs_dir in runs_dirs:
+        if not os.path.isdir(runs_dir):
+            continue
+        for file in sorted(os.listdir(runs_dir)):
+            if file.endswith('_metrics.csv'):
+                path = os.path.join(runs_dir, file)
+                # an empty or truncated file (a run killed while writing its header) is skipped, with a warning, instead of failing the listing
+                try:
+                    meta = read_run_meta(path)
+                except (OSError, ValueError) as e:
+                    print(f'skipping {path}, unreadable run metadata ({e})')
+                    continue
+                rows.append({'name': meta.get('experiment_name', file[:-len('_metrics.csv')]), 'dir': runs_dir, 'path': path, 'params': meta.get('params')})
+    return pd.DataFrame(rows, columns=['name', 'dir', 'path', 'params'])
+
+
+def summarize_runs(index):
+    rows = []
+    for run in index.itertuples():
+        metrics = load_run(run.path)
+        # a run still in its first epoch (or killed there) has only the header, it's listed with no results
+        best = metrics['val_acc'].idxmax() if metrics['val_acc'].notna().any() else None
+        rows.append({
+            'name': run.name,
+            'dir': run.dir,
+            'best_val_acc': np.nan if best is None else metrics['val_acc'][best],
+            'best_epoch': np.nan if best is None else int(metrics['epoch'][best]),
+            'epochs': len(metrics),
+            'params': run.params,
+            'wall_time_s': metrics['epoch_time'].sum(min_count=1),
+            'images_per_sec': metrics['images_per_sec'].mean(),
+        })
+    columns = ['name', 'dir', 'best_val_acc', 'best_epoch', 'epochs', 'params', 'wall_time_s', 'images_per_sec']
+    return pd.DataFrame(rows, columns=columns).sort_values('best_val_acc', ascending=False, ignore_index=True)
+
+
+def plot_runs(index, metrics=('val_acc', 'val_loss'), fontsize=18, legend_max=20):
+    cmap = plt.get_cmap('tab20' if len(index) <= 20 else 'viridis')
+    colors = [cmap(i / max(len(index) - 1, 1)) if len(index) > 20 else cmap(i) for i in range(len(index))]
+    fig, axes = plt.subplots(1, len(metrics), figsize=(25, 10), squeeze=False)
+    runs = [load_run(path) for path in index['path']]
+    for ax, metric in zip(axes[0], metrics):
+        segments = [np.column_stack([run['epoch'].values, run[metric].values]) for run in runs]
+        ax.add_collection(LineCollection(segments, colors=colors, linewidths=1.5))
+        ax.autoscale()
+        ax.set_title(metric, fontsize=fontsize)
+        ax.set_xlabel('Epoch', fontsize=fontsize)
+        ax.tick_params(labelsize=fontsize)
+    if len(index) <= legend_max:
+        labels = [f'{name} ({d})' for name, d in zip(index['name'], index['dir'])]
+        axes[0][0].legend([plt.Line2D([], [], color=c) for c in colors], labels, fontsize=fontsize * 2 // 3)
+    plt.show()
+
+
+# %%
+runs = index_runs()
+plot_runs(runs)
+summarize_runs(runs)
+
+
 # %%
 # count the number of images that there are for every class, in order to see if the model is biased towards some classes
 
@@ -1214,7 +1840,7 @@ print(f'Mean F1: {mean_f1:.3f}')
 # ## <center>SIFT and Bag of Words for feature extraction
 
 # %%
-def extract_sift_features(image_path):
+def extract_sift_features(image_path, sift=None):
     image = cv2.imread(image_path)
     if image is None:
         print(f"Failed to load image at {image_path}")
@@ -1222,7 +1848,8 @@ def extract_sift_features(image_path):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     # resize image
     gray = cv2.resize(gray, (128, 128))
-    sift = cv2.SIFT_create()
+    if sift is None:
+        sift = cv2.SIFT_create()
     keypoints, descriptors = sift.detectAndCompute(gray, None)
     if descriptors is None:
         # No descriptors found, return an empty array
@@ -1237,103 +1864,451 @@ def extract_sift_features_from_df(df, root_dir):
     return features
 
 
+# %%
+# parallel version of the extraction, every worker of the process pool creates its own SIFT detector once and reuses it for all its images.
+# the descriptors are not kept in a list of ragged arrays, they are written in order into a single packed (n_descriptors, 128) file plus an
+# offsets index, image i owns the rows offsets[i]:offsets[i+1]. SIFT descriptors are integers in [0, 255], so uint8 storage is lossless
+
+_worker_sift = None
+
+def _init_sift_worker():
+    global _worker_sift
+    cv2.setNumThreads(1)
+    _worker_sift = cv2.SIFT_create()
+
+def _sift_worker(image_path):
+    return extract_sift_features(image_path, _worker_sift)
+
+
+class PackedFeatures:
+    def __init__(self, descriptors, offsets):
+        self.descriptors = descriptors
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.descriptors[self.offsets[idx]:self.offsets[idx + 1]]
+
+    @classmethod
+    def from_list(cls, features, dtype=np.float32):
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(f) for f in features])
+        descriptors = np.concatenate(features).astype(dtype) if offsets[-1] > 0 else np.empty((0, 128), dtype=dtype)
+        return cls(descriptors, offsets)
+
+
+def extract_sift_features_packed(df, root_dir, output_prefix, n_workers=8, chunksize=64, dtype=np.uint8):
+    paths = [os.path.join(root_dir, name) for name in df.iloc[:, 0]]
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    with open(output_prefix + '_descriptors.bin', 'wb') as f, mp.Pool(n_workers, initializer=_init_sift_worker) as pool:
+        for i, descriptors in enumerate(tqdm(pool.imap(_sift_worker, paths, chunksize=chunksize), total=len(paths))):
+            f.write(np.ascontiguousarray(descriptors, dtype=dtype).tobytes())
+            offsets[i + 1] = offsets[i] + len(descriptors)
+    np.save(output_prefix + '_offsets.npy', offsets)
+    pickle.dump({'dtype': np.dtype(dtype).str, 'dim': 128}, open(output_prefix + '_meta.pkl', 'wb'))
+    return load_packed_features(output_prefix)
+
+
+def load_packed_features(prefix):
+    meta = pickle.load(open(prefix + '_meta.pkl', 'rb'))
+    offsets = np.load(prefix + '_offsets.npy')
+    if offsets[-1] == 0:
+        return PackedFeatures(np.empty((0, meta['dim']), dtype=meta['dtype']), offsets)
+    descriptors = np.memmap(prefix + '_descriptors.bin', dtype=meta['dtype'], mode='r', shape=(int(offsets[-1]), meta['dim']))
+    return PackedFeatures(descriptors, offsets)
+
 
 # %%
-def extract_bag_of_words(features, dictionary):
-    bow = []
-    for i in tqdm(range(len(features))):
-        if features[i].size > 0:  # Skip if features[i] is empty
-            words = dictionary.predict(features[i].astype(np.float32))
-            bow.append(np.bincount(words, minlength=dictionary.n_clusters))
-        else:
-            bow.append(np.zeros(dictionary.n_clusters, dtype=np.float32))  # Append zeros if no features
-    return np.array(bow)
+# throughput of the serial extraction against the process pool on a subset of the training set
+
+n_bench = 2000
+bench_df = train_df.iloc[:n_bench]
+
+start = time.perf_counter()
+extract_sift_features_from_df(bench_df, 'dataset/train_set')
+serial_time = time.perf_counter() - start
+
+start = time.perf_counter()
+extract_sift_features_packed(bench_df, 'dataset/train_set', 'dataset/bench_features', n_workers=os.cpu_count())
+parallel_time = time.perf_counter() - start
+
+print(f'serial:   {n_bench / serial_time:.1f} images/s')
+print(f'parallel: {n_bench / parallel_time:.1f} images/s ({os.cpu_count()} workers, {serial_time / parallel_time:.1f}x)')
+
 
 
 # %%
-def extract_save_bag_of_words(features, dictionary, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
-    for i in tqdm(range(len(features))):
-        if features[i].size > 0:  # Skip if features[i] is empty
-            words = dictionary.predict(features[i].astype(np.float32))
-            bow_features = np.bincount(words, minlength=dictionary.n_clusters)
-        else:
-            bow_features = np.zeros(dictionary.n_clusters, dtype=np.float32)  # Append zeros if no features
-        # take the name from the df
-        filename = f"bow_features_{i}.npy"
-        np.save(os.path.join(output_dir, filename), bow_features)
+# nearest centroid for a whole chunk of descriptors at once using ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, ||x||^2 doesn't change the argmin so it's dropped
+
+def assign_words(descriptors, centers, centers_sq=None):
+    if centers_sq is None:
+        centers_sq = (centers ** 2).sum(axis=1)
+    distances = centers_sq - 2 * (descriptors @ centers.T)
+    return distances.argmin(axis=1)
+
+
+# %%
+# the word assignment is pluggable: a quantizer only needs `n_clusters` and `predict(descriptors)`, sklearn k-means dictionaries are wrapped in a BruteForceQuantizer.
+# both quantizers below work on blocks of descriptors so the distance matrices stay around block_bytes, whatever the number of descriptors passed to predict.
+# BruteForceQuantizer is the exact search, KMeansTreeQuantizer is a two level hierarchical k-means tree: the dictionary centers are clustered
+# into n_branches groups and every descriptor is compared only against the centers of its n_probe closest groups, which makes big vocabularies
+# (10k+ words) affordable at the price of some assignments not being the exact nearest word
+
+def descriptor_blocks(n_descriptors, n_columns, block_bytes=64 * 2**20):
+    # rows per block so that a float32 (rows, n_columns) matrix takes about block_bytes
+    block = max(block_bytes // (4 * max(n_columns, 1)), 1)
+    return [(start, min(start + block, n_descriptors)) for start in range(0, n_descriptors, block)]
+
+
+class BruteForceQuantizer:
+    def __init__(self, centers, block_bytes=64 * 2**20):
+        self.cluster_centers_ = np.asarray(centers, dtype=np.float32)
+        self.n_clusters = len(self.cluster_centers_)
+        self.centers_sq = (self.cluster_centers_ ** 2).sum(axis=1)
+        self.block_bytes = block_bytes
+
+    def predict(self, descriptors):
+        descriptors = np.asarray(descriptors)
+        words = np.empty(len(descriptors), dtype=np.int64)
+        for start, end in descriptor_blocks(len(descriptors), self.n_clusters, self.block_bytes):
+            words[start:end] = assign_words(descriptors[start:end].astype(np.float32), self.cluster_centers_, self.centers_sq)
+        return words
+
+
+class KMeansTreeQuantizer:
+    def __init__(self, centers, n_branches=None, n_probe=4, random_state=0, block_bytes=64 * 2**20):
+        self.cluster_centers_ = np.asarray(centers, dtype=np.float32)
+        self.n_clusters = len(self.cluster_centers_)
+        self.block_bytes = block_bytes
+        self.n_branches = n_branches or int(np.sqrt(self.n_clusters))
+        self.n_probe = min(n_probe, self.n_branches)
+
+        coarse = KMeans(n_clusters=self.n_branches, n_init=1, random_state=random_state).fit(self.cluster_centers_)
+        self.coarse = BruteForceQuantizer(coarse.cluster_centers_)
+        self.members = [np.flatnonzero(coarse.labels_ == g) for g in range(self.n_branches)]
+        self.leaves = [BruteForceQuantizer(self.cluster_centers_[m]) for m in self.members]
+
+    def predict(self, descriptors):
+        descriptors = np.asarray(descriptors)
+        words = np.empty(len(descriptors), dtype=np.int64)
+        # the largest matrix of a block is the coarse or one leaf distance matrix
+        widest = max([self.n_branches] + [leaf.n_clusters for leaf in self.leaves])
+        for start, end in descriptor_blocks(len(descriptors), widest, self.block_bytes):
+            words[start:end] = self.predict_block(descriptors[start:end].astype(np.float32))
+        return words
+
+    def predict_block(self, descriptors):
+        coarse_distances = self.coarse.centers_sq - 2 * (descriptors @ self.coarse.cluster_centers_.T)
+        probes = np.argpartition(coarse_distances, self.n_probe - 1, axis=1)[:, :self.n_probe]
+
+        best_distance = np.full(len(descriptors), np.inf, dtype=np.float32)
+        best_word = np.zeros(len(descriptors), dtype=np.int64)
+        for g, leaf in enumerate(self.leaves):
+            rows = np.flatnonzero((probes == g).any(axis=1))
+            if rows.size == 0 or leaf.n_clusters == 0:
+                continue
+            distances = leaf.centers_sq - 2 * (descriptors[rows] @ leaf.cluster_centers_.T)
+            nearest = distances.argmin(axis=1)
+            nearest_distance = distances[np.arange(len(rows)), nearest]
+            better = nearest_distance < best_distance[rows]
+            best_distance[rows[better]] = nearest_distance[better]
+            best_word[rows[better]] = self.members[g][nearest[better]]
+        return best_word
+
+
+def as_quantizer(dictionary):
+    if isinstance(dictionary, (KMeans, MiniBatchKMeans)):
+        return BruteForceQuantizer(dictionary.cluster_centers_)
+    if hasattr(dictionary, 'n_clusters') and hasattr(dictionary, 'predict'):
+        return dictionary
+    raise TypeError(f'{type(dictionary).__name__} is not a quantizer, it needs n_clusters and predict(descriptors)')
+
+
+# recall is the fraction of descriptors that get the same word as the exact search, the words of a BruteForceQuantizer in the report are reused
+# as the exact ones instead of searching a second time
+def quantizer_report(quantizers, descriptors):
+    descriptors = np.asarray(descriptors, dtype=np.float32)
+    results = {}
+    for name, quantizer in quantizers.items():
+        start = time.perf_counter()
+        words = quantizer.predict(descriptors)
+        results[name] = (words, time.perf_counter() - start)
+    exact = next((results[name][0] for name, quantizer in quantizers.items() if isinstance(quantizer, BruteForceQuantizer)), None)
+    if exact is None:
+        exact = BruteForceQuantizer(next(iter(quantizers.values())).cluster_centers_).predict(descriptors)
+    return pd.DataFrame([{'quantizer': name, 'recall': np.mean(words == exact), 'descriptors/s': len(descriptors) / elapsed}
+                         for name, (words, elapsed) in results.items()])
+
+
+# %%
+# vectorized bag of words: the descriptors of a block of images are assigned to their words in one call of the quantizer, then the histograms of
+# the whole block are built with a single bincount over local_image_index * n_clusters + word. Every block writes to its own rows of the output,
+# so blocks can run in a thread pool (numpy releases the gil)
+
+def encode_bag_of_words(features, dictionary, chunk_descriptors=16384, n_threads=1):
+    if not isinstance(features, PackedFeatures):
+        features = PackedFeatures.from_list(features)
+    quantizer = as_quantizer(dictionary)
+    n_clusters = quantizer.n_clusters
+    offsets = features.offsets
+    bow = np.zeros((len(features), n_clusters), dtype=np.float32)
+
+    # split the images in blocks of roughly chunk_descriptors descriptors each
+    bounds = np.searchsorted(offsets, np.arange(chunk_descriptors, offsets[-1], chunk_descriptors))
+    bounds = np.unique(np.concatenate([[0], bounds, [len(features)]]))
+
+    def encode_block(block):
+        a, b = block
+        start, end = offsets[a], offsets[b]
+        if end == start:
+            return
+        words = quantizer.predict(features.descriptors[start:end])
+        image_idx = np.repeat(np.arange(b - a), np.diff(offsets[a:b + 1]))
+        bow[a:b] = np.bincount(image_idx * n_clusters + words, minlength=(b - a) * n_clusters).reshape(b - a, n_clusters)
+
+    blocks = list(zip(bounds[:-1], bounds[1:]))
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(tqdm(executor.map(encode_block, blocks), total=len(blocks)))
+    else:
+        for block in tqdm(blocks):
+            encode_block(block)
+    return bow
+
+
+# %%
+def extract_bag_of_words(features, dictionary, n_threads=1):
+    return encode_bag_of_words(features, dictionary, n_threads=n_threads)
+
+
+# %%
+# the whole bow matrix is saved in a single file instead of one .npy per image, dense as a .npy that is memory mapped when loaded,
+# or as a CSR .npz since every image only uses a small fraction of the words of the dictionary
+
+def extract_save_bag_of_words(features, dictionary, output_path, sparse=False, n_threads=1):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    bow = encode_bag_of_words(features, dictionary, n_threads=n_threads)
+    if sparse:
+        sp.save_npz(output_path, sp.csr_matrix(bow))
+    else:
+        np.save(output_path, bow)
+
+
+def load_bow_matrix(path):
+    if path.endswith('.npz'):
+        return sp.load_npz(path).tocsr()
+    return np.load(path, mmap_mode='r')
 
 
 # %%
 force_recompute_sift = False
 force_recompute_bow = False
 
-if not os.path.exists('dataset/train_features.pkl') or force_recompute_sift:
-    train_features = extract_sift_features_from_df(train_df, 'dataset/train_set')
-    pickle.dump(train_features, open('dataset/train_features.pkl', 'wb'))
-    #test_features = extract_sift_features_from_df(test_df, 'dataset/test_set')
-    #pickle.dump(test_features, open('dataset/test_features.pkl', 'wb'))
-    val_features = extract_sift_features_from_df(val_df, 'dataset/val_set')
-    pickle.dump(val_features, open('dataset/val_features.pkl', 'wb'))
+if not os.path.exists('dataset/train_features_offsets.npy') or force_recompute_sift:
+    train_features = extract_sift_features_packed(train_df, 'dataset/train_set', 'dataset/train_features')
+    #test_features = extract_sift_features_packed(test_df, 'dataset/test_set', 'dataset/test_features')
+    val_features = extract_sift_features_packed(val_df, 'dataset/val_set', 'dataset/val_features')
 else:
-    train_features = pickle.load(open('dataset/train_features.pkl', 'rb'))
-    val_features = pickle.load(open('dataset/val_features.pkl', 'rb'))
+    train_features = load_packed_features('dataset/train_features')
+    val_features = load_packed_features('dataset/val_features')
+
+# %%
+# streaming codebook: instead of concatenating every descriptor of the training set in memory and calling fit, the packed descriptors are read
+# from disk in chunks (visited in random order, consecutive images are often of the same class) and fed to partial_fit, peak memory only depends
+# on chunk_size. With sample_size the chunks first go through a reservoir sampler and only the reservoir is used to train the dictionary
+
+def reservoir_sample(chunks, sample_size, rng):
+    reservoir = None
+    seen = 0
+    for chunk in chunks:
+        if reservoir is None:
+            reservoir = np.empty((sample_size, chunk.shape[1]), dtype=np.float32)
+        n_fill = min(max(sample_size - seen, 0), len(chunk))
+        reservoir[seen:seen + n_fill] = chunk[:n_fill]
+        # every following item replaces a random slot with probability sample_size / (its position + 1)
+        rest = chunk[n_fill:]
+        positions = seen + n_fill + np.arange(len(rest))
+        slots = rng.integers(0, positions + 1)
+        keep = slots < sample_size
+        reservoir[slots[keep]] = rest[keep]
+        seen += len(chunk)
+    return reservoir[:min(seen, sample_size)]
+
+
+def build_codebook_streaming(features, n_clusters, chunk_size=100000, sample_size=None, n_epochs=1, random_state=0):
+    rng = np.random.default_rng(random_state)
+    chunk_size = max(chunk_size, 3 * n_clusters)  # partial_fit needs more samples than clusters in the first call
+
+    # the chunks are at least chunk_size long, the remainder is spread over them instead of ending up in a tiny last chunk
+    def read_chunks(descriptors):
+        bounds = np.linspace(0, len(descriptors), max(len(descriptors) // chunk_size, 1) + 1).astype(np.int64)
+        for i in rng.permutation(len(bounds) - 1):
+            yield np.asarray(descriptors[bounds[i]:bounds[i + 1]], dtype=np.float32)
+
+    descriptors = features.descriptors[features.offsets[0]:features.offsets[-1]]
+    if sample_size is not None:
+        descriptors = reservoir_sample(read_chunks(descriptors), sample_size, rng)
+
+    dictionary = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, batch_size=chunk_size)
+    for epoch in range(n_epochs):
+        for chunk in tqdm(read_chunks(descriptors), total=max(len(descriptors) // chunk_size, 1), desc=f'codebook epoch {epoch+1}/{n_epochs}'):
+            dictionary.partial_fit(chunk)
+    return dictionary
+
+
+def measure(fn, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+# %%
+# time and peak memory of concatenate-then-fit against the streaming builder, on the descriptors of a subset of the training set
+
+def fit_concatenated(features, n_clusters):
+    dictionary = MiniBatchKMeans(n_clusters=n_clusters, random_state=0)
+    dictionary.fit(np.concatenate([np.asarray(features[i], dtype=np.float32) for i in range(len(features))]))
+    return dictionary
+
+n_bench = 10000
+bench_features = PackedFeatures(train_features.descriptors, train_features.offsets[:n_bench + 1])
+
+for name, fn, kwargs in [('concatenate + fit', fit_concatenated, {}),
+                         ('streaming', build_codebook_streaming, {}),
+                         ('streaming + reservoir', build_codebook_streaming, {'sample_size': 200000})]:
+    _, elapsed, peak = measure(fn, bench_features, 1000, **kwargs)
+    print(f'{name:>22}: {elapsed:8.1f} s, peak memory {peak:8.1f} MB')
+
 
 # %%
 n_clusters = 1000
 
 if not os.path.exists('dataset/dictionary.pkl') or force_recompute_bow:
-    dictionary = MiniBatchKMeans(n_clusters=n_clusters, random_state=0)
-    dictionary.fit(np.concatenate(train_features))
+    dictionary = build_codebook_streaming(train_features, n_clusters)
     pickle.dump(dictionary, open('dataset/dictionary.pkl', 'wb'))
 else:
     dictionary = pickle.load(open('dataset/dictionary.pkl', 'rb'))
 
 
 # %%
-extract_save_bag_of_words(train_features, dictionary, 'dataset/train_bow')
-extract_save_bag_of_words(val_features, dictionary, 'dataset/val_bow')
+# recall/speed trade-off of the tree against the exact search, on a 10k words vocabulary trained on a reservoir sample of the descriptors
+
+large_dictionary = build_codebook_streaming(train_features, 10000, sample_size=2000000)
+sample = train_features.descriptors[:200000]
+
+quantizers = {'brute force': BruteForceQuantizer(large_dictionary.cluster_centers_)}
+for n_probe in [1, 2, 4, 8, 16]:
+    quantizers[f'kmeans tree, {n_probe} probes'] = KMeansTreeQuantizer(large_dictionary.cluster_centers_, n_branches=100, n_probe=n_probe)
+quantizer_report(quantizers, sample)
 
 
 # %%
-#train_bow = extract_bag_of_words(train_features, dictionary)
-#del train_features
-#extract_bag_of_words(val_features, dictionary)
-#del val_features
+bow_sparse = False
+bow_ext = '_csr.npz' if bow_sparse else '.npy'
+
+if not os.path.exists('dataset/train_bow' + bow_ext) or force_recompute_bow:
+    extract_save_bag_of_words(train_features, dictionary, 'dataset/train_bow' + bow_ext, sparse=bow_sparse)
+    extract_save_bag_of_words(val_features, dictionary, 'dataset/val_bow' + bow_ext, sparse=bow_sparse)
+
 
 # %%
-# SVM
-# clf = SVC()
-# clf.fit(train_bow, train_df.iloc[:, 1], )
-# train_pred = clf.predict(train_bow)
-# val_pred = clf.predict(val_bow)
-# # save to file
-# pickle.dump(train_pred, open('dataset/svm_train_pred.pkl', 'wb'))
-# pickle.dump(val_pred, open('dataset/svm_val_pred.pkl', 'wb'))
+# classical baselines on the bow matrix. SVC() is quadratic in the number of samples and doesn't finish on 120k images, so the svm path
+# uses an explicit feature map approximating the chi-squared kernel (the usual kernel for histograms) followed by linear svms, which scale
+# linearly with the samples and work directly on the sparse CSR matrix. The one-vs-rest svms and the trees of the random forest are fitted
+# in parallel, fitted models and predictions are cached in models/baselines so every baseline is trained only once. The cache files are named
+# after a hash of the inputs (shape, format and content of the bow matrices and the labels), so a new dictionary, a recomputed bow or the
+# sparse/dense switch trains the baseline again instead of reusing stale models
+
+def make_baseline(name, n_jobs=-1):
+    if name == 'linear_svm':
+        return make_pipeline(Normalizer(norm='l1'), OneVsRestClassifier(LinearSVC(C=1.0), n_jobs=n_jobs))
+    if name == 'chi2_svm':
+        return make_pipeline(Normalizer(norm='l1'), AdditiveChi2Sampler(sample_steps=2), OneVsRestClassifier(LinearSVC(C=1.0), n_jobs=n_jobs))
+    if name == 'random_forest':
+        return RandomForestClassifier(n_estimators=300, n_jobs=n_jobs, random_state=0)
+    raise ValueError(f'unknown baseline {name}')
+
+
+def inputs_hash(*arrays, length=10):
+    h = hashlib.sha1()
+    for array in arrays:
+        if sp.issparse(array):
+            array = array.tocsr()
+            parts = [array.data, array.indices, array.indptr]
+        else:
+            parts = [np.asarray(array)]
+        h.update(f'{type(array).__name__}{array.shape}'.encode())
+        for part in parts:
+            h.update(np.ascontiguousarray(part).data)
+    return h.hexdigest()[:length]
 
-# train_acc = accuracy_score(train_df.iloc[:, 1], train_pred)
-# val_acc = accuracy_score(val_df.iloc[:, 1], val_pred)
 
-# print(f'SVM Train Accuracy: {train_acc:.3f}, Val Accuracy: {val_acc:.3f}')
+def fit_baseline(name, train_bow, train_labels, val_bow, cache_dir='models/baselines', force_refit=False):
+    os.makedirs(cache_dir, exist_ok=True)
+    key = inputs_hash(train_bow, train_labels, val_bow)
+    model_path = os.path.join(cache_dir, f'{name}_{key}.pkl')
+    pred_path = os.path.join(cache_dir, f'{name}_{key}_pred.npz')
+
+    if os.path.exists(model_path) and os.path.exists(pred_path) and not force_refit:
+        clf = pickle.load(open(model_path, 'rb'))
+        pred = np.load(pred_path)
+        return clf, pred['train'], pred['val']
+
+    clf = make_baseline(name)
+    start = time.perf_counter()
+    clf.fit(train_bow, train_labels)
+    print(f'{name} fitted in {time.perf_counter() - start:.1f} s')
+    pickle.dump(clf, open(model_path, 'wb'))
+
+    train_pred = clf.predict(train_bow)
+    val_pred = clf.predict(val_bow)
+    np.savez(pred_path, train=train_pred, val=val_pred)
+    return clf, train_pred, val_pred
+
+
+# %%
+train_bow = load_bow_matrix('dataset/train_bow' + bow_ext)
+val_bow = load_bow_matrix('dataset/val_bow' + bow_ext)
+
+for name in ['chi2_svm', 'random_forest']:
+    _, train_pred, val_pred = fit_baseline(name, train_bow, train_df.iloc[:, 1].values, val_bow)
+    train_acc = accuracy_score(train_df.iloc[:, 1], train_pred)
+    val_acc = accuracy_score(val_df.iloc[:, 1], val_pred)
+    print(f'{name} Train Accuracy: {train_acc:.3f}, Val Accuracy: {val_acc:.3f}')
 
 # %% [markdown]
 # ----
 # ## <center>CNN with BoW features
 
 # %%
+# the bow matrix is opened once (memory mapped if dense) and indexed directly, for the CSR variant the row is scattered into a dense vector
+
 class FoodBowDataset(Dataset):
-    def __init__(self, df, bow_dir, root_dir, transform=None):
+    def __init__(self, df, bow_path, root_dir, transform=None):
         self.df = df
-        self.bow_dir = bow_dir
+        self.bow = load_bow_matrix(bow_path)
         self.root_dir = root_dir
         self.transform = transform
         
     def __len__(self):
         return len(self.df)
+
+    def get_bow(self, idx):
+        if sp.issparse(self.bow):
+            start, end = self.bow.indptr[idx], self.bow.indptr[idx + 1]
+            bow = np.zeros(self.bow.shape[1], dtype=np.float32)
+            bow[self.bow.indices[start:end]] = self.bow.data[start:end]
+            return bow
+        return np.array(self.bow[idx], dtype=np.float32)
     
     def __getitem__(self, idx):
-        bow = np.load(os.path.join(self.bow_dir, f'bow_features_{idx}.npy'))
-        bow = bow.astype(np.float32)  # Convert bow features to float
+        bow = self.get_bow(idx)
         img_name = os.path.join(self.root_dir, self.df.iloc[idx, 0])
         image = Image.open(img_name)
 
@@ -1353,28 +2328,46 @@ transform = transforms.Compose([
     transforms.Normalize(mean=[.485, .456, .406], std=[.229, .224, .225]),
 ])
 
-train_bow_ds = FoodBowDataset(train_df, 'dataset/train_bow', 'dataset/train_set', transform)
-val_bow_ds = FoodBowDataset(val_df, 'dataset/val_bow', 'dataset/val_set', transform)
+train_bow_ds = FoodBowDataset(train_df, 'dataset/train_bow' + bow_ext, 'dataset/train_set', transform)
+val_bow_ds = FoodBowDataset(val_df, 'dataset/val_bow' + bow_ext, 'dataset/val_set', transform)
 
 train_bow_dl = DataLoader(train_bow_ds, batch_size=256, shuffle=True, num_workers=8)
 val_bow_dl = DataLoader(val_bow_ds, batch_size=256, shuffle=False, num_workers=8)
 
 
 # %%
+# the image branch is configurable, the original one ('flatten') feeds the 64x32x32 feature maps to a 33.5M parameters dense layer, which dominates the
+# whole model. 'pool' average pools the feature maps down to pool_size x pool_size before the dense layer, 'tinynet' replaces the two convolutions
+# with the conv blocks of a tinyNet encoder (e.g. the ssl pretrained one), whose output is already 32x4x4, freeze_encoder keeps it fixed:
+# no gradients and the encoder stays in eval mode even when the model is put in train mode, so its batchnorm statistics don't drift
+
 class FoodBowCNN(nn.Module):
-    def __init__(self, n_clusters, n_classes):
+    def __init__(self, n_clusters, n_classes, image_branch='pool', pool_size=4, encoder=None, freeze_encoder=False):
         super(FoodBowCNN, self).__init__()
         self.n_clusters = n_clusters
         self.n_classes = n_classes
+        self.image_branch = image_branch
+        self.freeze_encoder = freeze_encoder and image_branch == 'tinynet'
         
         # Convolutional layers for image feature extraction
-        self.conv1 = nn.Conv2d(3, 32, kernel_size=3, stride=1, padding=1)
-        self.conv2 = nn.Conv2d(32, 64, kernel_size=3, stride=1, padding=1)
-        self.pool = nn.MaxPool2d(kernel_size=2, stride=2)
+        if image_branch == 'tinynet':
+            encoder = encoder if encoder is not None else tinyNet()
+            self.encoder = Sequential(encoder.conv1, encoder.conv2, encoder.conv3, encoder.conv4, encoder.conv5)
+            for p in self.encoder.parameters():
+                p.requires_grad = not freeze_encoder
+            image_features = 32 * 4 * 4
+        elif image_branch in ('flatten', 'pool'):
+            self.conv1 = nn.Conv2d(3, 32, kernel_size=3, stride=1, padding=1)
+            self.conv2 = nn.Conv2d(32, 64, kernel_size=3, stride=1, padding=1)
+            self.pool = nn.MaxPool2d(kernel_size=2, stride=2)
+            self.adaptive_pool = nn.AdaptiveAvgPool2d(pool_size) if image_branch == 'pool' else nn.Identity()
+            image_features = 64 * pool_size * pool_size if image_branch == 'pool' else 64 * 32 * 32
+        else:
+            raise ValueError(f'unknown image branch {image_branch}')
         self.dropout = nn.Dropout(p=0.25)
         
         # Fully connected layers for image features
-        self.fc1 = nn.Linear(64 * 32 * 32, 512)
+        self.fc1 = nn.Linear(image_features, 512)
         self.fc2 = nn.Linear(512, 256)
         
         # Fully connected layers for BoW features
@@ -1386,14 +2379,28 @@ class FoodBowCNN(nn.Module):
         self.combined_fc2 = nn.Linear(512, n_classes)
         
         self.relu = nn.ReLU()
+        self.train()
+
+    def train(self, mode=True):
+        super(FoodBowCNN, self).train(mode)
+        if self.freeze_encoder:
+            self.encoder.eval()
+        return self
+
+    def image_features(self, image):
+        if self.image_branch == 'tinynet':
+            x = self.encoder(image)
+        else:
+            x = self.pool(self.relu(self.conv1(image)))
+            x = self.pool(self.relu(self.conv2(x)))
+            x = self.adaptive_pool(x)
+        x = torch.flatten(x, 1)
+        x = self.relu(self.fc1(x))
+        return self.relu(self.fc2(x))
         
     def forward(self, bow_features, image):
         # Image feature extraction
-        x = self.pool(self.relu(self.conv1(image)))
-        x = self.pool(self.relu(self.conv2(x)))
-        x = x.view(-1, 64 * 32 * 32)
-        x = self.relu(self.fc1(x))
-        img_features = self.relu(self.fc2(x))
+        img_features = self.image_features(image)
         
         # BoW feature processing
         bow_features = self.relu(self.bow_fc1(bow_features))
@@ -1411,65 +2418,66 @@ class FoodBowCNN(nn.Module):
 
 
 # %%
-def bow_train(model, train_dl, val_dl, optimizer, criterion, epochs):
-    train_loss = []
-    val_loss = []
-    train_acc = []
-    val_acc = []
+# parameter count and cpu training throughput (forward + backward + optimizer step on random batches) of the image branches
+
+def benchmark_bow_cnn(model, batch_size=64, n_batches=10, device='cpu'):
+    model = model.to(device).train()
+    bow = torch.rand(batch_size, model.n_clusters, device=device)
+    image = torch.randn(batch_size, 3, 128, 128, device=device)
+    labels = torch.randint(0, model.n_classes, (batch_size,), device=device)
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=0.001)
+    criterion = torch.nn.CrossEntropyLoss()
+
+    for i in range(n_batches + 1):
+        if i == 1:  # the first step is a warmup
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        loss = criterion(model(bow, image), labels)
+        loss.backward()
+        optimizer.step()
+    return batch_size * n_batches / (time.perf_counter() - start)
+
+
+bow_cnn_configs = {
+    'flatten': lambda: FoodBowCNN(n_clusters, 251, image_branch='flatten'),
+    'pool 4x4': lambda: FoodBowCNN(n_clusters, 251, image_branch='pool', pool_size=4),
+    'pool 8x8': lambda: FoodBowCNN(n_clusters, 251, image_branch='pool', pool_size=8),
+    'tinynet': lambda: FoodBowCNN(n_clusters, 251, image_branch='tinynet'),
+    'tinynet frozen': lambda: FoodBowCNN(n_clusters, 251, image_branch='tinynet', freeze_encoder=True),
+}
+
+rows = []
+for name, make_model in bow_cnn_configs.items():
+    bow_cnn = make_model()
+    rows.append({'image branch': name,
+                 'parameters': sum(p.numel() for p in bow_cnn.parameters()),
+                 'trainable': sum(p.numel() for p in bow_cnn.parameters() if p.requires_grad),
+                 'images/s (cpu)': benchmark_bow_cnn(bow_cnn)})
+    del bow_cnn
+pd.DataFrame(rows)
 
-    for epoch in range(epochs):
-        model.train()
-        running_loss = 0.0
-        correct = 0
-        total = 0
-        for i, data in enumerate(train_dl):
-            bow, image, labels = data
-            bow, image, labels = bow.to(device), image.to(device), labels.to(device)
-            
-            optimizer.zero_grad()
-            
-            outputs = model(bow, image)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            
-            running_loss += loss.item()
-            
-            _, predicted = torch.max(outputs.data, 1)
-            total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-            
-        train_loss.append(running_loss/len(train_dl))
-        train_acc.append(100*correct/total)
-        
-        model.eval()
-        running_loss = 0.0
-        correct = 0
-        total = 0
-        with torch.no_grad():
-            for i, data in enumerate(val_dl):
-                bow, image, labels = data
-                bow, image, labels = bow.to(device), image.to(device), labels.to(device)
-                
-                outputs = model(bow, image)
-                loss = criterion(outputs, labels)
-                
-                running_loss += loss.item()
-                
-                _, predicted = torch.max(outputs.data, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-                
-        val_loss.append(running_loss/len(val_dl))
-        val_acc.append(100*correct/total)
-        
-        print(f'Epoch: {epoch+1}/{epochs}, Train Loss: {train_loss[-1]:.3f}, Train Acc: {train_acc[-1]:.3f}%, Val Loss: {val_loss[-1]:.3f}, Val Acc: {val_acc[-1]:.3f}%')
-        
-model = FoodBowCNN(n_clusters, 251).to(device)
+
+# %%
+# FoodBowCNN goes through the same train() as tinyNet, the (bow, image, label) batches are unpacked and passed to the model as model(bow, image)
+
+# the image branch can also start from the ssl encoder, e.g. image_branch='tinynet', encoder=torch.load(f'models/ssl/ssl_tinynetClassicv2.pth').encoder
+model = FoodBowCNN(n_clusters, 251, image_branch='pool', pool_size=4).to(device)
 criterion = torch.nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=0.001)
 epochs = 100
+experiment_name = 'foodBowCNN_pool4'
+writer = SummaryWriter('runs/'+experiment_name)
 print(f'the model has {sum(p.numel() for p in model.parameters())} parameters')
 
-train(model, train_bow_dl, val_bow_dl, optimizer, criterion, epochs)
+train(model=model,
+      train_dl=train_bow_dl,
+      val_dl=val_bow_dl,
+      optimizer=optimizer,
+      criterion=criterion,
+      scheduler=None,
+      epochs=epochs,
+      writer=writer,
+      experiment_name=experiment_name,
+      best_experiment_name=experiment_name,
+      device=device)
 
@@ -0,0 +1,121 @@
+import io
+import os
+import csv
+import time
+import argparse
+import torch
+import pandas as pd
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+from tqdm import tqdm
+
+from serve import load_model, load_class_names, transform_val
+
+# Batch prediction over an unlabeled image set, e.g.
+#   python predict.py --checkpoint models/best_tinyNetClassic.pth --output predictions/test_predictions.csv
+# Images are decoded by --workers DataLoader processes and predictions are appended to the csv after every batch, in the order of the info file.
+# If the csv already exists the rows already written are skipped, so an interrupted run resumes where it stopped.
+
+
+class ImageListDataset(Dataset):
+    def __init__(self, names, root_dir, transform):
+        self.names = names
+        self.root_dir = root_dir
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        # a broken image must not stop a nightly run, it gets an empty prediction instead
+        try:
+            image = Image.open(os.path.join(self.root_dir, self.names[idx])).convert('RGB')
+            return self.transform(image), True
+        except OSError:
+            return torch.zeros(3, 128, 128), False
+
+
+def truncate_partial_row(output):
+    # a run killed while writing leaves a last line without its newline, it's cut so the next rows are not glued to it
+    with open(output, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def count_done(output, names):
+    if not os.path.exists(output):
+        return 0
+    truncate_partial_row(output)
+    if os.path.getsize(output) == 0:
+        return 0
+    done = pd.read_csv(output, usecols=['image'])['image'].tolist()
+    if done != names[:len(done)]:
+        raise ValueError(f'{output} does not match the order of the info file, remove it to start over')
+    return len(done)
+
+
+def predict(args):
+    names = pd.read_csv(args.info, header=None).iloc[:, 0].tolist()
+    done = count_done(args.output, names)
+    if done == len(names):
+        print(f'{args.output} is already complete')
+        return
+    print(f'{done}/{len(names)} images already predicted' if done else f'predicting {len(names)} images')
+
+    model = load_model(args.checkpoint, args.device)
+    class_names = load_class_names(args.class_list)
+    ds = ImageListDataset(names[done:], args.root_dir, transform_val)
+    dl = DataLoader(ds, batch_size=args.batch_size, shuffle=False, num_workers=args.workers, pin_memory=args.device != 'cpu')
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    # the header may already be there without any row (a run stopped during its first batch)
+    new_file = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+    n_images = 0
+    start = time.perf_counter()
+    # the rows of a batch are formatted in memory and written with a single write, so the file only grows by whole batches
+    # (a kill during that write is repaired by count_done on the next run)
+    with open(args.output, 'a', newline='') as f, torch.no_grad():
+        if new_file:
+            f.write('image,label,class,score,top_k\r\n')
+            f.flush()
+        pbar = tqdm(dl, unit='batch')
+        for images, ok in pbar:
+            probabilities = torch.softmax(model(images.to(args.device, non_blocking=True)), dim=1)
+            scores, indices = probabilities.topk(args.top_k, dim=1)
+            scores, indices = scores.cpu().tolist(), indices.cpu().tolist()
+
+            buffer = io.StringIO()
+            out = csv.writer(buffer)
+            for i in range(len(ok)):
+                name = names[done + n_images + i]
+                if ok[i]:
+                    out.writerow([name, indices[i][0], class_names[indices[i][0]], f'{scores[i][0]:.6f}', ' '.join(map(str, indices[i]))])
+                else:
+                    out.writerow([name, '', '', '', ''])
+            f.write(buffer.getvalue())
+            f.flush()
+            n_images += len(ok)
+            pbar.set_postfix({'images/s': f'{n_images / (time.perf_counter() - start):.1f}'})
+
+    elapsed = time.perf_counter() - start
+    print(f'{n_images} images in {elapsed:.1f} s, {n_images / elapsed:.1f} images/s')
+
+    if args.parquet:
+        pd.read_csv(args.output, dtype={'top_k': str}).to_parquet(args.parquet, index=False)
+        print(f'written {args.parquet}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='predict the classes of an unlabeled image set with a tinyNet checkpoint')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--info', default='dataset/test_info.csv')
+    parser.add_argument('--root-dir', default='dataset/test_set')
+    parser.add_argument('--class-list', default='dataset/class_list.txt')
+    parser.add_argument('--output', default='predictions/test_predictions.csv')
+    parser.add_argument('--parquet', default=None, help='also write the complete predictions to this parquet file')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=8, help='decode workers')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    predict(parser.parse_args())
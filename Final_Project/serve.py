@@ -0,0 +1,275 @@
+import io
+import json
+import asyncio
+import argparse
+import torch
+import pandas as pd
+from urllib.parse import urlsplit, parse_qs
+from torch.nn import Conv2d, MaxPool2d, Linear, BatchNorm2d, Dropout, Sequential, Module, GELU
+from torchvision import transforms
+from PIL import Image
+
+# Local inference server for tinyNet checkpoints, e.g.
+#   python serve.py --checkpoint models/best_tinyNetClassic.pth --port 8000
+#   curl --data-binary @dataset/val_set/val_000001.jpg 'http://localhost:8000/predict?top_k=5'
+# The checkpoint is loaded once, concurrent requests are coalesced into batches by DynamicBatcher.
+# tinyNet is redefined here as in the notebook, checkpoints store the whole model so the class has to be found in __main__ when unpickling.
+
+
+class tinyNet(Module):
+    def __init__(self, c1_filters=8, c2_filters=32, c3_filters=64, c4_filters=128, c5_filters=172, fc1_units=256):
+        super(tinyNet, self).__init__()
+        self.conv1 = Sequential(
+            Conv2d(3, c1_filters, kernel_size=3, stride=1, padding='same'),
+            GELU(),
+            Conv2d(c1_filters, c2_filters, kernel_size=3, stride=1, padding=1),
+            BatchNorm2d(c2_filters),
+            GELU(),
+            MaxPool2d(kernel_size=2, stride=2, padding=0)
+        )
+        self.conv2 = Sequential(
+            Conv2d(c2_filters, c2_filters, kernel_size=3, stride=1, padding='same'),
+            GELU(),
+            Conv2d(c2_filters, c3_filters, kernel_size=3, stride=1, padding=1),
+            BatchNorm2d(c3_filters),
+            GELU(),
+            MaxPool2d(kernel_size=2, stride=2, padding=0)
+        )
+        self.conv3 = Sequential(
+            Conv2d(c3_filters, c3_filters, kernel_size=3, stride=1, padding='same'),
+            GELU(),
+            Conv2d(c3_filters, c4_filters, kernel_size=3, stride=1, padding=1),
+            BatchNorm2d(c4_filters),
+            GELU(),
+            MaxPool2d(kernel_size=2, stride=2, padding=0)
+        )
+
+        self.conv4 = Sequential(
+            Conv2d(c4_filters, c4_filters, kernel_size=3, stride=1, padding='same'),
+            GELU(),
+            Conv2d(c4_filters, c5_filters, kernel_size=3, stride=1, padding=1),
+            BatchNorm2d(c5_filters),
+            GELU(),
+            MaxPool2d(kernel_size=2, stride=2, padding=0)
+        )
+
+        self.conv5 = Sequential(
+            Conv2d(c5_filters, c5_filters, kernel_size=3, stride=1, padding='same'),
+            GELU(),
+            Conv2d(c5_filters, 32, kernel_size=3, stride=1, padding=1),
+            BatchNorm2d(32),
+            GELU(),
+            MaxPool2d(kernel_size=2, stride=2, padding=0)
+        )
+
+        self.fc1 = Sequential(
+            Linear(32*4*4, fc1_units),
+            Dropout(.2),
+            GELU()
+        )
+
+        self.fc2 = Sequential(
+            Linear(fc1_units, 251),
+            GELU()
+        )
+
+    def forward(self, x):
+        x = self.conv1(x)
+        x = self.conv2(x)
+        x = self.conv3(x)
+        x = self.conv4(x)
+        x = self.conv5(x)
+        x = x.reshape(-1, 32*4*4)
+        x = self.fc1(x)
+        x = self.fc2(x)
+        return x
+
+
+transform_val = transforms.Compose([
+    transforms.Resize((128, 128)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[.485, .456, .406], std=[.229, .224, .225]),
+])
+
+
+def load_class_names(path='dataset/class_list.txt'):
+    class_list = pd.read_csv(path, header=None, sep=' ', names=['class', 'name'], index_col=0)
+    return class_list['name'].values
+
+
+def load_model(checkpoint_path, device='cpu'):
+    # the notebook pickles whole models as __main__.tinyNet, make the class findable there whichever script is running
+    import __main__
+    if not hasattr(__main__, 'tinyNet'):
+        __main__.tinyNet = tinyNet
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model = checkpoint['model'] if isinstance(checkpoint, dict) else checkpoint
+    model.to(device)
+    model.eval()
+    return model
+
+
+def decode_image(data):
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    return transform_val(image)
+
+
+# requests wait in a queue, a single loop takes the first one and keeps adding requests to the batch until it's full or until the first request
+# has waited max_latency_ms, then the batch goes through the model. Decoding and the forward pass run in worker threads (torch and PIL release the gil),
+# so the event loop keeps accepting connections and filling the next batch in the meantime
+
+class DynamicBatcher:
+    def __init__(self, model, class_names, max_batch_size=64, max_latency_ms=10, device='cpu'):
+        self.model = model
+        self.class_names = class_names
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.device = device
+        self.queue = asyncio.Queue()
+        self.n_batches = 0
+        self.n_images = 0
+
+    async def decode(self, data):
+        return await asyncio.get_running_loop().run_in_executor(None, decode_image, data)
+
+    async def predict(self, image, top_k=5):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self.queue.put((image, top_k, future))
+        return await future
+
+    def infer(self, images, top_k):
+        with torch.no_grad():
+            batch = torch.stack(images).to(self.device)
+            probabilities = torch.softmax(self.model(batch), dim=1)
+            scores, indices = probabilities.topk(top_k, dim=1)
+        return scores.cpu().tolist(), indices.cpu().tolist()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            images = [image for image, _, _ in items]
+            top_k = min(max(k for _, k, _ in items), len(self.class_names))
+            try:
+                scores, indices = await loop.run_in_executor(None, self.infer, images, top_k)
+            except Exception as e:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.n_batches += 1
+            self.n_images += len(items)
+            for (_, k, future), batch_scores, batch_indices in zip(items, scores, indices):
+                if not future.done():
+                    future.set_result([{'index': i, 'class': str(self.class_names[i]), 'score': s}
+                                       for s, i in zip(batch_scores[:k], batch_indices[:k])])
+
+
+# ------------------------------ HTTP ------------------------------
+# a minimal HTTP/1.1 server with keep-alive, it only needs to understand POST /predict (raw image bytes as the body) and GET /health
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+async def route(method, target, body, batcher):
+    url = urlsplit(target)
+    if url.path == '/health':
+        return 200, {'status': 'ok', 'batches': batcher.n_batches, 'images': batcher.n_images,
+                     'mean_batch_size': batcher.n_images / max(batcher.n_batches, 1)}
+    if url.path != '/predict':
+        return 404, {'error': f'unknown path {url.path}'}
+    if method != 'POST':
+        return 405, {'error': 'use POST with the image as the body'}
+
+    n_classes = len(batcher.class_names)
+    try:
+        top_k = int(parse_qs(url.query).get('top_k', ['5'])[0])
+    except ValueError:
+        return 400, {'error': 'top_k must be an integer'}
+    if not 1 <= top_k <= n_classes:
+        return 400, {'error': f'top_k must be between 1 and {n_classes}'}
+
+    try:
+        image = await batcher.decode(body)
+    except (OSError, ValueError) as e:
+        return 400, {'error': f'invalid image: {e}'}
+    try:
+        predictions = await batcher.predict(image, top_k)
+    except Exception as e:
+        return 500, {'error': f'inference failed: {e}'}
+    return 200, {'predictions': predictions}
+
+
+async def handle_connection(reader, writer, batcher):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            status, payload = await route(method, target, body, batcher)
+            response = json.dumps(payload).encode()
+            writer.write(f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+                         f'Content-Type: application/json\r\n'
+                         f'Content-Length: {len(response)}\r\n\r\n'.encode('latin-1') + response)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    model = load_model(args.checkpoint, args.device)
+    batcher = DynamicBatcher(model, load_class_names(args.class_list), args.max_batch_size, args.max_latency_ms, args.device)
+    batcher_task = asyncio.create_task(batcher.run())
+
+    def handler(reader, writer):
+        return handle_connection(reader, writer, batcher)
+
+    if args.unix:
+        server = await asyncio.start_unix_server(handler, path=args.unix)
+        print(f'serving {args.checkpoint} on unix socket {args.unix}')
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        print(f'serving {args.checkpoint} on http://{args.host}:{args.port}')
+    async with server:
+        await server.serve_forever()
+    batcher_task.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='dynamic batching inference server for tinyNet checkpoints')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--class-list', default='dataset/class_list.txt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', default=None, help='listen on this unix socket instead of tcp')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=10)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    asyncio.run(serve(parser.parse_args()))